@@ -25,7 +25,7 @@ setup(
     },
     include_package_data=True,
     install_requires=[
-        'django>=1.7',
+        'django>=1.8',
     ],
     classifiers=[
         'Environment :: Web Environment',
@@ -24,7 +24,18 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf import settings
 settings.CACHE_DEBUG = getattr(settings, 'CACHE_DEBUG', False)
+settings.ARGCACHE_HASH_TOKENS = getattr(settings, 'ARGCACHE_HASH_TOKENS', False)
+settings.ARGCACHE_INCR_TOKENS = getattr(settings, 'ARGCACHE_INCR_TOKENS', False)
+settings.ARGCACHE_TOKEN_TIMEOUT = getattr(settings, 'ARGCACHE_TOKEN_TIMEOUT', 86400)
+settings.ARGCACHE_TOKEN_JITTER = getattr(settings, 'ARGCACHE_TOKEN_JITTER', 0.1)
+settings.ARGCACHE_CACHE = getattr(settings, 'ARGCACHE_CACHE', 'default')
+settings.ARGCACHE_TOKEN_CACHE = getattr(settings, 'ARGCACHE_TOKEN_CACHE', None)
+settings.ARGCACHE_CACHES = getattr(settings, 'ARGCACHE_CACHES', {})
+settings.ARGCACHE_ON_COMMIT = getattr(settings, 'ARGCACHE_ON_COMMIT', True)
+settings.ARGCACHE_PATH_DEPTH = getattr(settings, 'ARGCACHE_PATH_DEPTH', 8)
 
 # Convenience imports
 from .function import cache_function, cache_function_for
-from .key_set import wildcard
+from .invalidation import invalidation_batch, invalidate_rows
+from .key_set import wildcard, subtree
+from .marinade import ref
@@ -22,14 +22,24 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from django.core.cache import cache
+import math
+import random
+import time
+
 from django.dispatch import Signal
 from django.db.models import signals
 from django.conf import settings
 
 from .queued import add_lazy_dependency
-from .token import Token, SingleEntryToken
-from .key_set import specifies_key, token_list_for
+from .backends import get_cache
+from .token import Token, PathToken, SingleEntryToken, digest_token_values, delete_tokens
+from .dependencies import add_dependency, propagate
+from .dispatch import dispatcher_for, instance_selector, fk_selector
+from .invalidation import invalidate, invalidation_batch, _instances, CHUNK_SIZE
+from .key_set import (specifies_key, token_list_for, has_wildcard, expand_key_sets, is_subtree,
+                      wildcard)
+from .local import LocalCache, token_snapshot
+from .scope import current_scope, remember, forget
 from .marinade import marinade_dish
 from .registry import register_cache
 from .sad_face import warn_if_loaded
@@ -43,36 +53,34 @@ __all__ = ['ArgCache']
 # compelling reason to extend it, this can be modified later.
 
 
-# TODO: Don't store each token with the final object, hash them together, to
-# avoid a ridiculous blowup in memory. This will make it about as memory
-# efficient as tiered caching. May be a performance hit though... not sure.
+# NOTE: With hash_tokens, we don't store each token with the final object, but
+# hash them together, to avoid a ridiculous blowup in memory. This makes it
+# about as memory efficient as tiered caching, at the cost of a hash on every
+# get(). Both formats are always understood by get(), so the setting can be
+# flipped on a live cache: old entries stay valid until they are next
+# rewritten (or expire), and new ones are written in the new format.
 #
 # I think it's worth it though... this also has the side effect that caches
 # have tokens and then can be used as handles maybe? Kind of another way to
 # express 1-1 dependencies... but offloading work from set() to get(), which
 # isn't so nice... Still, perhaps some relations are hard to reverse.
 #
-# Also, can we pretend we never get a hash collision here?
+# Also, can we pretend we never get a hash collision here? With md5, yes.
 
 
-# TODO: This scheme does not allow for sets that involve things like
-# everything-below-this-DataTree-node, which could be very useful for UserBit
-# stuff. At least the simplest version could fixed by implementing the
-# BatchableCache thing and then extending to allow multiple keys per token
-# (well, actually the token will just look at lots of keys without telling
-# anyone). This also will allow for depending on param signature and stuff.
-# However, this does not scale well. i.e., it's O(depth) work, which may be
-# fine for one token, but several? Also, if some token does two such queries at
-# once (say... V + Q...). it's O(depth^2) work. The hashing thing will help
-# with memory, but still... Gack! I think this is not a blocker though. Tiered
-# caching couldn't do this either... this is simply something we don't know how
-# to implement at all, as far as I know.
+# NOTE: Sets like everything-below-this-DataTree-node, which are very useful
+# for UserBit stuff, are done with path tokens (get_or_create_path_token() and
+# subtree()): an entry looks at one token per level of its path, which is
+# O(depth) reads, but they go in the same get_many as everything else, and
+# the depth is bounded. Deleting a subtree is then a single key. Sets which
+# aren't prefixes of something (say... V + Q...) still can't be done.
 
 
-# TODO: To be really useful, this system needs to track old values of fields,
+# NOTE: To be really useful, this system needs to track old values of fields,
 # even though we usually don't do things like reassign Event to another
-# Program. This shouldn't be hard... monkey patch the models on a as-needed
-# basis.
+# Program. depend_on_row(..., fields=[...]) does, for the fields it's given,
+# by keeping a snapshot of them on each instance as it is loaded (see
+# changes.py); without fields, only the new values are seen.
 
 
 # TODO: We need to be able to notice when a bunch of things got update and
@@ -131,30 +139,126 @@ __all__ = ['ArgCache']
 # more general tokens thing, which more-or-less depends on async caching
 
 
+class _Lookup(object):
+    """ A lookup in progress: what's known already, and what to fetch. """
+
+    def __init__(self, cache_obj, arg_lists, plans):
+        self.cache_obj = cache_obj
+        self.arg_lists = arg_lists
+        self.plans = plans
+        self.ans_dict = {}
+        self.keys_to_get = set()
+        self.token_keys = set()
+
+    def requests(self):
+        """ Returns a list of (backend, keys) to fetch. """
+        cache_obj = self.cache_obj
+        if cache_obj.token_cache is cache_obj.cache:
+            requests = [(cache_obj.cache, self.keys_to_get)]
+        else:
+            requests = [(cache_obj.cache, self.keys_to_get - self.token_keys),
+                        (cache_obj.token_cache, self.keys_to_get & self.token_keys)]
+        return [(backend, keys) for backend, keys in requests if keys]
+
+
 class ArgCache(object):
     """ Implements a cache that allows for selectively dropping bits of itself. """
 
     CACHE_NONE = {} # we could use a garbage string for this, but it's impossible to collide with the id of a dict.
 
-    def __init__(self, name, params, cache=cache, timeout_seconds=None, *args, **kwargs):
+    def __init__(self, name, params, cache=None, timeout_seconds=None, hash_tokens=None, incr_tokens=None,
+                 token_cache=None, token_timeout=None, token_jitter=None,
+                 local_entries=None, local_bytes=None, local_token_ttl=0, stale_ttl=None,
+                 xfetch_beta=1.0, *args, **kwargs):
         super(ArgCache, self).__init__(*args, **kwargs)
 
         if isinstance(params, list):
             params = tuple(params)
         self.name = name
+        self._key_prefix = name + '|'
         self.params = params
-        self.cache = cache
+
+        # Values go to cache, and tokens to token_cache, either of which may
+        # be a backend or an alias in settings.CACHES. Tokens can be kept in a
+        # different backend from the values, perhaps a faster one or one with
+        # more room, so that they aren't evicted to make room for values
+        # (which loses everything that depended on them). Unless given, these
+        # come from settings.ARGCACHE_CACHES[name], and then
+        # ARGCACHE_CACHE and ARGCACHE_TOKEN_CACHE; tokens go with the values
+        # if nothing says otherwise.
+        overrides = settings.ARGCACHE_CACHES.get(name, {})
+        if cache is None:
+            cache = overrides.get('cache', settings.ARGCACHE_CACHE)
+        if token_cache is None:
+            token_cache = overrides.get('token_cache', settings.ARGCACHE_TOKEN_CACHE)
+        self.cache = get_cache(cache)
+        if token_cache is None:
+            self.token_cache = self.cache
+        else:
+            self.token_cache = get_cache(token_cache)
         self.timeout_seconds = timeout_seconds
+        if hash_tokens is None:
+            hash_tokens = settings.ARGCACHE_HASH_TOKENS
+        self.hash_tokens = hash_tokens
+        if incr_tokens is None:
+            incr_tokens = settings.ARGCACHE_INCR_TOKENS
+        self.incr_tokens = incr_tokens
+
+        # See Token for these
+        self.token_timeout = token_timeout
+        self.token_jitter = token_jitter
+
+        # Optionally keep recently used entries in this process too. They are
+        # still checked against the tokens, which are fetched from the cache
+        # unless they were read less than local_token_ttl seconds ago. Other
+        # processes can't delete our copies, so each entry then gets a token
+        # of its own, which invalidations of single entries delete instead.
+        if local_entries is not None or local_bytes is not None:
+            self.local_cache = LocalCache(max_entries=local_entries, max_bytes=local_bytes)
+        else:
+            self.local_cache = None
+        self.local_token_ttl = local_token_ttl
+
+        # If set, an entry whose tokens have changed is still served for up to
+        # stale_ttl seconds after that is first noticed, while the first caller
+        # to notice recomputes it.
+        self.stale_ttl = stale_ttl
+
+        # Entries that expire (and whose computation was timed) are
+        # occasionally treated as misses shortly before they expire, more so
+        # the longer they took to compute, so that they're recomputed before
+        # everyone misses at once. Larger betas refresh earlier; 0 turns this
+        # off. See "Optimal Probabilistic Cache Stampede Prevention" (Vattani
+        # et al.)
+        self.xfetch_beta = xfetch_beta
         self.tokens = []
         self.token_dict = {}
+        # specified params -> the token to delete with; see find_token()
+        self._token_index = {}
+        # params provided -> the PathTokens for each level, shallowest first;
+        # see get_or_create_path_token()
+        self.path_tokens = {}
         self.locked = False
 
+        # (cache_obj, mapping_func, filter) for caches which depend on this
+        # one; see depend_on_cache()
+        self.dependents = []
+        # models this cache declares dependencies on, whichever way; see
+        # autodepend.dependency_report()
+        self.declared_models = set()
+
         # Mostly used to avoid recursion
         self.disabled = False
 
         # Init stats
         self.hit_count = 0
+        self.local_hit_count = 0
+        self.stale_hit_count = 0
         self.miss_count = 0
+        # how often an invalidation had to use a broader token than it asked
+        # for, and for which params; a token for those would save misses
+        self.rounded_count = 0
+        self.roundings = {}
 
         # Be able to invert param mapping
         self.param_dict = {}
@@ -163,8 +267,10 @@ class ArgCache(object):
 
         # FIXME: Really ought to depend on param signature.
         #self.global_token = ExternalToken(name=name, provided_params=(), external=hash(params))
-        self.global_token = Token(name=name, provided_params=(), cache=self.cache)
+        self.global_token = self._make_token(name, ())
         self.add_token(self.global_token)
+        if self.local_cache is not None:
+            self.get_or_create_token(params)
 
         # Calling in the constructor to avoid duplicates
         if warn_if_loaded():
@@ -180,6 +286,13 @@ class ArgCache(object):
             self.disabled = old_disabled
         self.hit_count += 1
 
+    def _stale_hit_hook(self, arg_list):
+        if settings.CACHE_DEBUG:
+            old_disabled, self.disabled = self.disabled, True
+            print "Stale Cache Hit! %s on %s" % (self.name, arg_list)
+            self.disabled = old_disabled
+        self.stale_hit_count += 1
+
     def _miss_hook(self, arg_list):
         if settings.CACHE_DEBUG:
             old_disabled, self.disabled = self.disabled, True
@@ -204,8 +317,8 @@ class ArgCache(object):
         cache_deleted.connect(handler, sender=self, weak=False) # local functions will be used a lot, so no weak refs
     connect.alters_data = True
     def send(self, key_set):
-        """ Internal: Send the signal. """
-        cache_deleted.send(sender=self, key_set=key_set)
+        """ Internal: Send the signal, and invalidate dependent caches. """
+        propagate(self, [key_set])
     send.alters_data = True
 
     def index_of_param(self, param):
@@ -224,26 +337,43 @@ class ArgCache(object):
 
     def key(self, arg_list):
         """ Returns a cache key, given a list of arguments. """
-        return self.name + '|' + ':'.join([marinade_dish(arg) for arg in arg_list])
-
-    def _token_keys(self, arg_list):
-        """ Returns a list of keys to grab for all the tokens. """
-        # TODO: Implement some sort of asynchronous caching for batching get_many
-        token_keys = []
-        for token in self.tokens:
-            token_keys.append(token.key(arg_list))
-        return token_keys
+        return self._key_prefix + ':'.join([marinade_dish(arg) for arg in arg_list])
 
     def add_token(self, token):
         """ Adds the given token to this cache. """
         self.tokens.append(token)
-        self.token_dict[token.provided_params] = token
+        # path tokens are in self.path_tokens instead, as their keys aren't
+        # made from the arguments as given
+        if not isinstance(token, PathToken):
+            self.token_dict[token.provided_params] = token
+        self._token_index = {}
         token.cache_obj = self
+        self._compile_key_plan()
     add_token.alters_data = True
 
+    def _compile_key_plan(self):
+        """ Works out how to make each token's key from the marinaded
+        arguments, so that _lookup_keys() marinades each argument once. A
+        token's plan is its key, if it has no params; or (prefix, indices),
+        or the token itself, as from key_plan(). """
+        self._key_plan = []
+        for token in self.tokens:
+            plan = token.key_plan()
+            if plan is None:
+                self._key_plan.append(token)
+            elif not plan[1]:
+                self._key_plan.append(plan[0])
+            else:
+                self._key_plan.append(plan)
+
+    def _make_token(self, name, provided_params):
+        """ Internal: makes a token stored the way this cache's tokens are. """
+        return Token(name, provided_params, cache=self.token_cache, incr=self.incr_tokens,
+                     timeout=self.token_timeout, jitter=self.token_jitter)
+
     def get_or_create_token(self, params):
         """ Ensures that a token exists for the given subset of the parameters. """
-        if len(params) == len(self.params):
+        if len(params) == len(self.params) and self.local_cache is None:
             # Make a fake proxy token
             # HACK of sorts... do NOT add it, as it's not really there
             return SingleEntryToken(self)
@@ -254,134 +384,478 @@ class ArgCache(object):
             return self.token_dict[provided_params]
         tname = ':'.join([self.params[i] for i in provided_params])
         tname = self.name + '|' + tname
-        t = Token(tname, provided_params, cache=self.cache)
+        t = self._make_token(tname, provided_params)
         self.add_token(t)
         return t
     get_or_create_token.alters_data = True
 
+    def get_or_create_path_token(self, path_param, params=(), depth=None):
+        """ Ensures that there are tokens for deleting subtree()s of
+        path_param, which should be a path (see key_set.path_parts()), for
+        each value of the other params. Subtrees deeper than depth get rounded
+        up to their ancestor at that depth; each level costs every entry one
+        more token to fetch, though it's in the same request. """
+        if depth is None:
+            depth = settings.ARGCACHE_PATH_DEPTH
+        path_index = self.index_of_param(path_param)
+        provided_params = [self.index_of_param(param) for param in params]
+        provided_params.append(path_index)
+        provided_params = tuple(sorted(set(provided_params)))
+        if self.path_tokens.has_key(provided_params):
+            return self.path_tokens[provided_params][-1]
+        tname = ':'.join([self.params[i] for i in provided_params])
+        tname = self.name + '|' + tname + '/'
+        tokens = []
+        for level in range(1, depth + 1):
+            t = PathToken(tname, provided_params, path_index, level, cache=self.token_cache,
+                          incr=self.incr_tokens, timeout=self.token_timeout,
+                          jitter=self.token_jitter)
+            self.add_token(t)
+            tokens.append(t)
+        self.path_tokens[provided_params] = tokens
+        return tokens[-1]
+    get_or_create_path_token.alters_data = True
+
     def find_token(self, key_set):
-        """ Return a token that can delete this key set. """
-        # Do we have a perfect match?
-        # FIXME: This is really awful...
+        """ Return a token that can delete this key set: the one for
+        exactly the params it specifies if there is one, or else the most
+        specific one that covers it. """
         provided_params = [self.index_of_param(param) for param in token_list_for(key_set)]
         provided_params.sort()
         provided_params = tuple(provided_params)
 
-        if self.token_dict.has_key(provided_params):
-            return self.token_dict[provided_params]
-        # FIXME: Come up with a smarter fallback solution count number of
-        # roundings? instead of contains, return a "closeness" heuristic?
-        for token in reversed(self.tokens):
-            if token.contains(key_set):
-                return token
-
-    def get(self, arg_list, default=None):
-        """ Get the value of the cache at arg_list (which can be a tuple). """
-        if self.disabled:
-            return default
-
-        key = self.key(arg_list)
-
-        # gather keys
-        keys_to_get = [key] + self._token_keys(arg_list)
+        token = self._token_index.get(provided_params)
+        if token is None:
+            token = self.token_dict.get(provided_params)
+            if token is None:
+                # the covering token with the most params; there's always the
+                # global token
+                specified = set(provided_params)
+                covering = [t for t in self.tokens if specified.issuperset(t.provided_params)
+                            and not isinstance(t, PathToken)]
+                token = max(covering, key=lambda t: len(t.provided_params))
+            self._token_index[provided_params] = token
+
+        if token.provided_params != provided_params:
+            self._round_hook(provided_params, token)
+        return token
+
+    def _subtree_token_key(self, key_set):
+        """ Returns the (token, key) to delete for a key set with subtree()s
+        in it, rounding up if necessary. """
+        provided_params = [self.index_of_param(param) for param in token_list_for(key_set)]
+        provided_params.sort()
+        provided_params = tuple(provided_params)
+        specified = set(provided_params)
+
+        candidates = []
+        for tokens in self.path_tokens.itervalues():
+            token = tokens[-1]
+            if not specified.issuperset(token.provided_params):
+                continue
+            # the path has to be a (nonempty) subtree, and the rest exact
+            values = [key_set[self.params[i]] for i in token.provided_params]
+            path = key_set[self.params[token.path_index]]
+            if (is_subtree(path) and path.parts and
+                    len([value for value in values if is_subtree(value)]) == 1):
+                candidates.append(token)
+        if not candidates:
+            # no path token fits, so round up to one that ignores the path
+            key_set = dict((param, wildcard if is_subtree(value) else value)
+                           for param, value in key_set.iteritems())
+            token = self.find_token(key_set)
+            return token, token.key_filt(token.filt_from_key_set(key_set))
+
+        token = max(candidates, key=lambda t: len(t.provided_params))
+        parts = key_set[self.params[token.path_index]].parts
+        if token.provided_params != provided_params or len(parts) > token.level:
+            self._round_hook(provided_params, token)
+        filt = token.filt_from_key_set(key_set)
+        filt[token.provided_params.index(token.path_index)] = parts[:token.level]
+        return token, token.key_filt(filt)
+
+    def _round_hook(self, provided_params, token):
+        params = tuple([self.params[i] for i in provided_params])
+        if settings.CACHE_DEBUG:
+            old_disabled, self.disabled = self.disabled, True
+            print "Rounding up! %s on %s to %s" % (self.name, params, token)
+            self.disabled = old_disabled
+        self.rounded_count += 1
+        self.roundings[params] = self.roundings.get(params, 0) + 1
 
-        # extract values
-        ans_dict = self.cache.get_many(keys_to_get)
-        wrapped_value = ans_dict.get(key, self.CACHE_NONE)
+    def _lookup_keys(self, arg_list):
+        """ Returns the value key and the token keys for arg_list. """
+        parts = [marinade_dish(arg) for arg in arg_list]
+        token_keys = []
+        for plan in self._key_plan:
+            if isinstance(plan, basestring):
+                token_keys.append(plan)
+            elif isinstance(plan, tuple):
+                prefix, indices = plan
+                token_keys.append(prefix + ':'.join([parts[i] for i in indices]))
+            else:
+                token_keys.append(plan.key(arg_list))
+        return self._key_prefix + ':'.join(parts), token_keys
+
+    def _wrap(self, value, token_values, timeout_seconds=None, compute_seconds=None):
+        """ Packs a value together with the token values it was computed
+        under, and when it will expire if we know how long it took. """
+        if self.hash_tokens:
+            wrapped_value = [value, digest_token_values(token_values)]
+        else:
+            wrapped_value = [value] + token_values
+        # Token values are never tuples, so this can't be mistaken for one
+        if self.xfetch_beta and timeout_seconds and compute_seconds is not None:
+            wrapped_value.append((compute_seconds, time.time() + timeout_seconds))
+        return wrapped_value
+
+    def _expiry_info(self, wrapped_value):
+        """ Returns (compute_seconds, expires_at) if the entry has them. """
+        if isinstance(wrapped_value[-1], tuple):
+            return wrapped_value[-1]
+        return None
+
+    def _expires_early(self, wrapped_value):
+        """ Decides whether to pretend a valid entry has expired already. """
+        info = self._expiry_info(wrapped_value)
+        if info is None or not self.xfetch_beta:
+            return False
+        compute_seconds, expires_at = info
+        # 1 - random() is in (0, 1], so the log is <= 0
+        gap = -compute_seconds * self.xfetch_beta * math.log(1.0 - random.random())
+        return time.time() + gap >= expires_at
+
+    def _unwrap(self, wrapped_value, token_keys, ans_dict):
+        """ Checks a stored value against the current token values in ans_dict.
+        Returns the original value, or CACHE_NONE if the tokens don't match. """
         if wrapped_value is self.CACHE_NONE:
-            self._miss_hook(arg_list)
-            return default
-        
+            return self.CACHE_NONE
         try:
-            # check tokens
-            if len(wrapped_value) != len(keys_to_get):
-                # shhhh... that value wasn't really there
-                self.cache.delete(key)
-                self._miss_hook(arg_list)
-                return default
-            for tvalue, tkey in zip(wrapped_value[1:], keys_to_get[1:]):
+            if self._expiry_info(wrapped_value) is not None:
+                wrapped_value = wrapped_value[:-1]
+            saved_values = []
+            for tkey in token_keys:
                 saved_value = ans_dict.get(tkey, self.CACHE_NONE)
+                if saved_value is self.CACHE_NONE:
+                    return self.CACHE_NONE
+                saved_values.append(saved_value)
+
+            # check tokens; token values are never strings, so a single
+            # string must be a digest
+            if len(wrapped_value) == 2 and isinstance(wrapped_value[1], str):
+                if wrapped_value[1] != digest_token_values(saved_values):
+                    return self.CACHE_NONE
+            elif list(wrapped_value[1:]) != saved_values:
                 # token mismatch!
-                if saved_value is self.CACHE_NONE or saved_value != tvalue:
-                    # shhhh... that value wasn't really there
-                    self.cache.delete(key)
-                    self._miss_hook(arg_list)
-                    return default
+                return self.CACHE_NONE
 
             # okay, it's good
-            self._hit_hook(arg_list)
             return wrapped_value[0]
-
         except Exception: # Don't die on errors, e.g. if wrapped_value is not a tuple/list
-            self._miss_hook(arg_list)
-            return default
+            return self.CACHE_NONE
+
+    def _time_left(self, wrapped_value):
+        """ How long the backend will keep an entry, as far as we know. """
+        info = self._expiry_info(wrapped_value)
+        if info is not None:
+            return max(info[1] - time.time(), 0)
+        # we don't know how long the backend has left, so this may outlive it
+        # by up to one timeout
+        return self.timeout_seconds
+
+    def _stale_key(self, key):
+        return 'STALE__' + key
+
+    def _check_stale(self, key, since):
+        """ Called when the entry at key is out of date, with the time in
+        its stale marker (fetched along with it), or None if there isn't one
+        yet. Returns whether to serve it anyway, and whether we are the one
+        who should refresh it. """
+        now = time.time()
+        if since is None:
+            stale_key = self._stale_key(key)
+            # The marker outlives the stale period, so that once that's over
+            # we don't start another one
+            if self.cache.add(stale_key, now, 2 * self.stale_ttl):
+                return True, True
+            since = self.cache.get(stale_key)
+        if since is not None and now - since < self.stale_ttl:
+            return True, False
+        return False, False
+
+    def _get_many(self, arg_lists, fill_tokens=False, refresh_stale=False):
+        """ Internal: looks up every arg_list in a single backend request.
+        Returns a list of values, with CACHE_NONE for misses; a dict of the
+        token values that were seen; and the set of indices of stale values
+        which the caller should refresh. If fill_tokens is True, tokens
+        missing for any miss (or refresh) are created before returning. Stale
+        values are only refreshed, and only served while someone else
+        refreshes them, if refresh_stale is True: callers which pass it must
+        refresh those they're given. """
+        lookup = self._begin_lookup(arg_lists)
+        fetched = {}
+        for backend, keys in lookup.requests():
+            fetched.update(backend.get_many(list(keys)))
+        return self._finish_lookup(lookup, fetched, fill_tokens, refresh_stale)
+
+    def _begin_lookup(self, arg_lists):
+        """ Internal: the first half of _get_many(). Works out which keys we
+        need from the backend, so that several lookups can share a request. """
+        plans = [self._lookup_keys(arg_list) for arg_list in arg_lists]
+        lookup = _Lookup(self, arg_lists, plans)
+
+        # gather keys; tokens are often shared, so only ask for each once
+        ans_dict = lookup.ans_dict
+        keys_to_get = lookup.keys_to_get
+        all_token_keys = lookup.token_keys
+        for key, token_keys in plans:
+            if self.local_cache is not None:
+                wrapped_value = self.local_cache.get(key, self.CACHE_NONE)
+                if wrapped_value is not self.CACHE_NONE:
+                    ans_dict[key] = wrapped_value
+            if key not in ans_dict:
+                keys_to_get.add(key)
+            if self.stale_ttl:
+                # in case it's stale, see whether anyone is refreshing it
+                keys_to_get.add(self._stale_key(key))
+            all_token_keys.update(token_keys)
+        if self.local_token_ttl:
+            ans_dict.update(token_snapshot.get_many(all_token_keys, self.local_token_ttl))
+        keys_to_get.update(all_token_keys.difference(ans_dict))
+        scope = current_scope()
+        if scope is not None:
+            ans_dict.update(scope.get_many(self.cache, keys_to_get - all_token_keys))
+            ans_dict.update(scope.get_many(self.token_cache, keys_to_get & all_token_keys))
+            keys_to_get.difference_update(ans_dict)
+        return lookup
+
+    def _finish_lookup(self, lookup, fetched, fill_tokens=False, refresh_stale=False):
+        """ Internal: the second half of _get_many(), given whatever the
+        backend had of the keys we asked for. """
+        arg_lists, plans = lookup.arg_lists, lookup.plans
+        ans_dict, all_token_keys = lookup.ans_dict, lookup.token_keys
+        fetched = dict((key, fetched[key]) for key in lookup.keys_to_get if key in fetched)
+        ans_dict.update(fetched)
+        fetched_tokens = dict((tkey, fetched[tkey]) for tkey in all_token_keys if tkey in fetched)
+        remember(self.cache, dict((key, value) for key, value in fetched.iteritems()
+                                  if key not in fetched_tokens))
+        remember(self.token_cache, fetched_tokens)
+        if self.local_token_ttl:
+            token_snapshot.set_many(fetched_tokens)
+
+        results = []
+        invalid_keys = []
+        token_values = {}
+        refresh = set()
+        for i, (arg_list, (key, token_keys)) in enumerate(zip(arg_lists, plans)):
+            wrapped_value = ans_dict.get(key, self.CACHE_NONE)
+            value = self._unwrap(wrapped_value, token_keys, ans_dict)
+            stale = unclaimed = False
+            if value is self.CACHE_NONE and wrapped_value is not self.CACHE_NONE and self.stale_ttl:
+                since = ans_dict.get(self._stale_key(key))
+                if since is None and not refresh_stale:
+                    # nobody is refreshing it, and we won't; leave it for
+                    # someone who will
+                    unclaimed = True
+                else:
+                    stale, should_refresh = self._check_stale(key, since)
+                if stale:
+                    value = wrapped_value[0]
+                    if should_refresh:
+                        refresh.add(i)
+            early = value is not self.CACHE_NONE and self._expires_early(wrapped_value)
+            if early:
+                # pretend it's gone, but leave it for everyone else
+                value = self.CACHE_NONE
+                self._miss_hook(arg_list)
+            elif stale:
+                self._stale_hit_hook(arg_list)
+            elif value is self.CACHE_NONE:
+                if self.local_cache is not None:
+                    self.local_cache.delete(key)
+                if key in fetched and not unclaimed:
+                    # shhhh... that value wasn't really there
+                    invalid_keys.append(key)
+                self._miss_hook(arg_list)
+            else:
+                if self.local_cache is not None:
+                    if key in fetched:
+                        self.local_cache.set(key, wrapped_value, self._time_left(wrapped_value))
+                    else:
+                        self.local_hit_count += 1
+                self._hit_hook(arg_list)
+            for tkey, token in zip(token_keys, self.tokens):
+                if tkey in fetched_tokens and tkey not in token_values:
+                    token.extend(tkey)
+                if ans_dict.has_key(tkey):
+                    token_values[tkey] = ans_dict[tkey]
+                elif fill_tokens and (value is self.CACHE_NONE or i in refresh):
+                    token_values[tkey] = ans_dict[tkey] = token.new_value(tkey)
+            results.append(value)
+        if invalid_keys:
+            self.cache.delete_many(invalid_keys)
+            forget(self.cache, invalid_keys)
+        return results, token_values, refresh
 
-    def set(self, arg_list, value, timeout_seconds=None):
-        """ Set the value of the cache at arg_list (which can be a tuple). """
+    def get(self, arg_list, default=None):
+        """ Get the value of the cache at arg_list (which can be a tuple). """
+        return self.get_many([arg_list], default)[0]
+
+    def get_many(self, arg_lists, default=None):
+        """ Get the values of the cache at each of arg_lists, using a single
+        request to the cache backend. Returns a list, with default in place of
+        anything that was missing. """
+        return self.get_many_with_tokens(arg_lists, default, fill_tokens=False)[0]
+
+    def get_with_tokens(self, arg_list, default=None):
+        """ Like get(), but also returns the token values the lookup saw. """
+        values, token_values = self.get_many_with_tokens([arg_list], default)
+        return values[0], token_values
+
+    def get_many_with_tokens(self, arg_lists, default=None, fill_tokens=True):
+        """
+        Like get_many(), but also returns a dict of the token values the
+        lookup saw, creating any that were missing for a miss.
+
+        Pass the dict to set() or set_many() when storing values computed
+        after the lookup: this saves refetching the tokens, and means that an
+        invalidation which happens while the value is being computed is not
+        lost.
+        """
         if self.disabled:
+            return [default] * len(arg_lists), {}
+
+        values, token_values, refresh = self._get_many(arg_lists, fill_tokens)
+        return [default if value is self.CACHE_NONE else value
+                for value in values], token_values
+
+    def set(self, arg_list, value, timeout_seconds=None, token_values=None, compute_seconds=None):
+        """ Set the value of the cache at arg_list (which can be a tuple). """
+        self.set_many([(arg_list, value)], timeout_seconds, token_values, [compute_seconds])
+    set.alters_data = True
+
+    def set_many(self, items, timeout_seconds=None, token_values=None, compute_seconds=None):
+        """ Set many values at once. items is a list of (arg_list, value)
+        pairs; tokens are looked up and values are stored with a single request
+        each. token_values, if given, is a dict of already-known token values
+        as returned by get_many_with_tokens(). compute_seconds, if given, is a
+        list of how long each value took to compute. """
+        if self.disabled or not items:
             return
+        if compute_seconds is None:
+            compute_seconds = [None] * len(items)
+        if timeout_seconds is None:
+            timeout_seconds = self.timeout_seconds
 
-        key = self.key(arg_list)
+        plans = [self._lookup_keys(arg_list) for arg_list, value in items]
+
+        ans_dict = dict(token_values or {})
 
         # gather keys
-        token_keys = self._token_keys(arg_list)
+        token_keys = set()
+        for key, tkeys in plans:
+            token_keys.update(tkeys)
+        token_keys.difference_update(ans_dict)
+
+        scope = current_scope()
+        if scope is not None:
+            ans_dict.update(scope.get_many(self.token_cache, token_keys))
+            token_keys.difference_update(ans_dict)
 
         # extract what values we can
         #  we use get_many here to optimize the common case: all tokens already present
-        ans_dict = self.cache.get_many(token_keys)
+        if token_keys:
+            fetched = self.token_cache.get_many(list(token_keys))
+            ans_dict.update(fetched)
+            remember(self.token_cache, fetched)
 
         # regenerate missing tokens
-        for tkey, token in zip(token_keys, self.tokens):
-            if not ans_dict.has_key(tkey):
-                ans_dict[tkey] = token.value_args(arg_list)
+        for (arg_list, value), (key, tkeys) in zip(items, plans):
+            for tkey, token in zip(tkeys, self.tokens):
+                if not ans_dict.has_key(tkey):
+                    ans_dict[tkey] = token.new_value(tkey)
 
         # gather token values
-        wrapped_value = [value]
-        for tkey in token_keys:
-            wrapped_value.append(ans_dict[tkey])
-
-        if timeout_seconds is None:
-            timeout_seconds = self.timeout_seconds
-            
-        self.cache.set(key, wrapped_value, timeout_seconds)
-    set.alters_data = True
-
-    def delete(self, arg_list):
+        to_set = {}
+        for (arg_list, value), (key, tkeys), seconds in zip(items, plans, compute_seconds):
+            to_set[key] = self._wrap(value, [ans_dict[tkey] for tkey in tkeys],
+                                     timeout_seconds, seconds)
+
+        self.cache.set_many(to_set, timeout_seconds)
+        remember(self.cache, to_set)
+        if self.stale_ttl:
+            self.cache.delete_many([self._stale_key(key) for key in to_set])
+        if self.local_cache is not None:
+            self.local_cache.set_many(to_set, timeout_seconds)
+    set_many.alters_data = True
+
+    def _delete_values(self, keys):
+        """ Internal: deletes the values at keys, with one request. """
+        keys = list(keys)
+        self.cache.delete_many(keys)
+        forget(self.cache, keys)
+        if self.local_cache is not None:
+            self.local_cache.delete_many(keys)
+    _delete_values.alters_data = True
+
+    def delete(self, arg_list, send_signal=True):
         """ Delete the value of the cache at arg_list (which can be a tuple). """
         key = self.key(arg_list)
         self.cache.delete(key)
+        forget(self.cache, [key])
         key_set = {}
         for i,arg in enumerate(arg_list):
             key_set[self.params[i]] = arg
-        self.send(key_set=key_set)
+        if self.local_cache is not None:
+            self.local_cache.delete(key)
+            # for other processes' copies
+            token = self.find_token(key_set)
+            delete_tokens([(token, token.key_filt(token.filt_from_key_set(key_set)))])
+        if send_signal:
+            self.send(key_set=key_set)
     delete.alters_data = True
 
-    def delete_key_set(self, key_set):
+    def delete_key_set(self, key_set, send_signal=True):
         """ Delete everything in this key_set, rounding up if necessary. """
-
-        if settings.CACHE_DEBUG:
-            print "Dumping from", self.name, "keyset", key_set
-
-        # TODO: Would be nicer if we could just make a
-        # proxy token for the single-element case
-        arg_list = self.is_arg_list(key_set)
-        if arg_list:
-            return self.delete(arg_list)
-        else:
-            token = self.find_token(key_set)
-            token.delete_key_set(key_set, send_signal=False) # We can send a more accurate signal
-            self.send(key_set=key_set)
+        self.delete_key_sets(key_set, send_signal)
     delete_key_set.alters_data = True
 
-    def delete_key_sets(self, list_or_set):
-        """ Delete one or multiple (including nested lists) key sets. 
+    def delete_key_sets(self, list_or_set, send_signal=True):
+        """ Delete one or multiple (including nested lists) key sets,
+        rounding up if necessary. Values and tokens are each deleted with one
+        request, and dependent caches hear about all the key sets at once.
             - Michael P 11/1/2009
         """
-        if isinstance(list_or_set, list):
-            for item in list_or_set:
-                self.delete_key_sets(item)
-        else:
-            self.delete_key_set(list_or_set)
+        key_sets = list(expand_key_sets(list_or_set))
+        if not key_sets:
+            return
+
+        if settings.CACHE_DEBUG:
+            print "Dumping from", self.name, "keysets", key_sets
+
+        # work out what to delete
+        value_keys = set()
+        token_keys = []
+        for key_set in key_sets:
+            arg_list = self.is_arg_list(key_set)
+            if any(is_subtree(value) for value in key_set.itervalues()):
+                token_keys.append(self._subtree_token_key(key_set))
+            elif arg_list and self.local_cache is None:
+                value_keys.add(self.key(arg_list))
+            else:
+                # with a local tier, single entries have tokens too
+                token = self.find_token(key_set)
+                filt = token.filt_from_key_set(key_set)
+                if has_wildcard(filt):
+                    raise ValueError("Tried to delete an argument set with a wildcard.")
+                token_keys.append((token, token.key_filt(filt)))
+
+        if value_keys:
+            self._delete_values(value_keys)
+        if token_keys:
+            delete_tokens(token_keys)
+        if send_signal:
+            propagate(self, key_sets)
     delete_key_sets.alters_data = True
 
     def has_key(self, arg_list):
@@ -416,16 +890,16 @@ class ArgCache(object):
         if self.locked:
             return
         def resolve_depend_on_model(Model):
+            self.declared_models.add(Model)
             if create_token:
                 self.get_or_create_token(token_list_for(key_set))
-            def delete_cb(sender, **kwargs):
-                self.delete_key_sets(key_set)
-            signals.post_save.connect(delete_cb, sender=Model, weak=False)
-            signals.pre_delete.connect(delete_cb, sender=Model, weak=False)
+            def delete_cb(using):
+                invalidate(self, key_set, using)
+            dispatcher_for(Model).add_model_handler(delete_cb)
         add_lazy_dependency(self, Model, resolve_depend_on_model)
     depend_on_model.alters_data = True
 
-    def depend_on_row(self, Model, selector, filter=None):
+    def depend_on_row(self, Model, selector, filter=None, fields=None):
         """
         Depend on a row of a Model when a row of this Model changes.
 
@@ -437,32 +911,57 @@ class ArgCache(object):
 
         Because of how common the case is, if selector is a string, we create
         the token automatically and use lambda instance : {selector: instance}
-        as the mapping function.
+        as the mapping function. Similarly, 'param=field' creates the token
+        for param, and maps it to what the foreign key field of the instance
+        points to; this is done with a ref(), so it doesn't need a query.
+
+        If fields is given, a save only evicts anything if one of those fields
+        changed (or the row was created), and then it evicts the key_sets for
+        both the old and the new values, so that selectors following a foreign
+        key in fields see it move. Fields count as changed if the save lists
+        them in update_fields, or else if they differ from when the instance
+        was loaded.
+
+        Selectors (and filters) are called once for each change to a row, by
+        everything that uses them, so it helps to share them between caches.
         """
         # Silently fail. This means the object has been double-loaded (Thanks,
         # Python/Django double-import)
         if self.locked:
             return
-        if filter is None:
-            filter = lambda instance: True
+        fk_name = None
         if isinstance(selector, str):
             # Special-case this
             selector_str = selector
-            selector = lambda instance: {selector_str: instance}
+            if '=' in selector_str:
+                selector_str, fk_name = selector_str.split('=', 1)
+            else:
+                selector = instance_selector(selector_str)
             # Make the token
             token = self.get_or_create_token((selector_str,))
 
         def resolve_depend_on_row(Model):
             if Model is None:
                 raise ValueError("Attempting to depend on Model None... this is a pretty dumb thing to do.")
-            def delete_cb(sender, instance, **kwargs):
-                if not filter(instance):
-                    return None
-                new_key_set = selector(instance)
-                if new_key_set is not None:
-                    self.delete_key_sets(new_key_set)
-            signals.post_save.connect(delete_cb, sender=Model, weak=False)
-            signals.pre_delete.connect(delete_cb, sender=Model, weak=False)
+            self.declared_models.add(Model)
+            selector_func = selector
+            if fk_name is not None:
+                selector_func = fk_selector(Model, fk_name, selector_str)
+            def delete_cb(key_sets, using):
+                invalidate(self, key_sets, using)
+            dispatcher = dispatcher_for(Model)
+            if fields is None:
+                dispatcher.add_row_handler(selector_func, filter, delete_cb)
+                return
+            def changed_cb(instance, old_instance, using):
+                with invalidation_batch():
+                    for row in [instance, old_instance]:
+                        if row is None or (filter is not None and not filter(row)):
+                            continue
+                        key_sets = selector_func(row)
+                        if key_sets is not None:
+                            invalidate(self, key_sets, using)
+            dispatcher.add_fields_handler(fields, selector_func, filter, delete_cb, changed_cb)
         add_lazy_dependency(self, Model, resolve_depend_on_row)
     depend_on_row.alters_data = True
 
@@ -493,18 +992,12 @@ class ArgCache(object):
         def resolve_depend_on_cache(cache_obj):
             if method_name is not None:
                 cache_obj = getattr(cache_obj, method_name)
-            def delete_cb(sender, key_set, **kwargs):
-                if not filter(**key_set):
-                    return None
-                new_key_set = mapping_func(**key_set)
-                if new_key_set is not None:
-                    self.delete_key_sets(new_key_set)
             # TODO: Handle timeouts and take the min of a timeout
-            cache_obj.connect(delete_cb)
+            add_dependency(cache_obj, self, mapping_func, filter)
         add_lazy_dependency(self, cache_obj, resolve_depend_on_cache)
     depend_on_cache.alters_data = True
 
-    def depend_on_m2m(self, Model, m2m_field, add_func, rem_func=None, filter=None):
+    def depend_on_m2m(self, Model, m2m_field, add_func, rem_func=None, filter=None, pks_only=False):
         """
         Depend on an m2m relation, field m2m_field of model Model, using
         add_func and rem_func. They should have the form
@@ -513,6 +1006,12 @@ class ArgCache(object):
             return { .... }
 
         If rem_func is omitted, add_func is used.
+
+        Each change can add or remove many objects at once, which are loaded
+        (a chunk at a time) to be passed to the functions. If pks_only is
+        True, nothing is loaded, and the functions are given primary keys for
+        both arguments instead, whichever side the change was made from (use
+        ref() to turn them back into instances in key sets).
         """
         # Silently fail. This means the object has been double-loaded (Thanks,
         # Python/Django double-import)
@@ -524,30 +1023,43 @@ class ArgCache(object):
             filter = lambda instance, object: True
 
         def resolve_depend_on_m2m(Model):
+            field = Model._meta.get_field(m2m_field)
             IntermediateModel = getattr(Model, m2m_field).through
-            def change_cb(sender, instance, action, model, pk_set, **kwargs):
+            self.declared_models.update([Model, IntermediateModel])
+            def change_cb(sender, instance, action, model, pk_set, using=None, **kwargs):
+                forward = isinstance(instance, Model)
                 if action == "post_add":
-                    objects = model.objects.filter(pk__in=pk_set)
                     selector = add_func
                 elif action == "pre_remove":
-                    objects = model.objects.filter(pk__in=pk_set)
                     selector = rem_func
                 elif action == "pre_clear":
-                    objects = model.objects.all()
+                    # only what's actually linked to instance
+                    if forward:
+                        mine, theirs = field.m2m_field_name(), field.m2m_reverse_field_name()
+                    else:
+                        mine, theirs = field.m2m_reverse_field_name(), field.m2m_field_name()
+                    pk_set = IntermediateModel._base_manager.using(using).filter(
+                        **{mine: instance.pk}).values_list(theirs, flat=True).iterator()
                     selector = rem_func
                 else:
                     return
-                if isinstance(instance, Model):
-                    for object in objects:
-                        do_delete(instance, object, selector, filter)
-                else: # reversed m2m; switch instance and object
-                    for object in objects:
-                        do_delete(object, instance, selector, filter)
-            def do_delete(instance, object, selector, filter):
+                if pks_only:
+                    objects = pk_set
+                    instance = instance.pk
+                else:
+                    objects = _instances(model, pk_set, using, CHUNK_SIZE)
+                with invalidation_batch():
+                    if forward:
+                        for object in objects:
+                            do_delete(instance, object, selector, filter, using)
+                    else: # reversed m2m; switch instance and object
+                        for object in objects:
+                            do_delete(object, instance, selector, filter, using)
+            def do_delete(instance, object, selector, filter, using):
                 if not filter(instance, object):
                     return None
                 new_key_set = selector(instance, object)
                 if new_key_set is not None:
-                    self.delete_key_sets(new_key_set)
+                    invalidate(self, new_key_set, using)
             signals.m2m_changed.connect(change_cb, sender=IntermediateModel, weak=False)
         add_lazy_dependency(self, Model, resolve_depend_on_m2m)
@@ -0,0 +1,193 @@
+""" Working out which models a cached function depends on from the SQL it runs. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import connections
+from django.db.models import signals
+
+from .invalidation import invalidate
+from .registry import all_caches
+
+__all__ = ['record_queries', 'models_for_queries', 'model_changed',
+           'dependency_report']
+
+@contextmanager
+def record_queries(queries):
+    """ Appends (alias, sql) to queries for each query run in this thread
+    within the block. Uses execute_wrapper() on connections which have it;
+    otherwise, turns on the debug cursor and reads its query log. """
+    def wrapper(execute, sql, params, many, context):
+        queries.append((context['connection'].alias, sql))
+        return execute(sql, params, many, context)
+
+    wrappers = []
+    logged = []
+    for conn in connections.all():
+        if hasattr(conn, 'execute_wrapper'):
+            wrapped = conn.execute_wrapper(wrapper)
+            wrapped.__enter__()
+            wrappers.append(wrapped)
+        else:
+            last = conn.queries_log[-1] if conn.queries_log else None
+            logged.append((conn, conn.force_debug_cursor, last))
+            conn.force_debug_cursor = True
+    try:
+        yield queries
+    finally:
+        for wrapped in reversed(wrappers):
+            wrapped.__exit__(None, None, None)
+        for conn, force_debug_cursor, last in logged:
+            conn.force_debug_cursor = force_debug_cursor
+            # the log is bounded, so find where we started from the end
+            new = []
+            for query in reversed(conn.queries_log):
+                if query is last:
+                    break
+                new.append((conn.alias, query['sql']))
+            new.reverse()
+            queries.extend(new)
+
+# alias -> [(quoted table name, Model)]
+_tables = {}
+
+def _tables_for(alias):
+    if alias not in _tables:
+        quote_name = connections[alias].ops.quote_name
+        _tables[alias] = [(quote_name(Model._meta.db_table), Model)
+                          for Model in apps.get_models(include_auto_created=True)
+                          if not Model._meta.proxy]
+    return _tables[alias]
+
+def models_for_queries(queries):
+    """ Returns the set of models whose tables appear in queries, a list of
+    (alias, sql) as recorded by record_queries(). Tables which aren't
+    models' (the database cache's, say) are ignored. """
+    models = set()
+    for alias, sql in queries:
+        for table, Model in _tables_for(alias):
+            if table in sql:
+                models.add(Model)
+    return models
+
+def _label(Model):
+    return '%s.%s' % (Model._meta.app_label, Model._meta.object_name)
+
+# Caches with auto_depend. What they infer is kept in the cache, so that
+# every process invalidates them alike, including processes that never
+# watched them compute.
+_auto_caches = []
+
+def _shared_key(cache_obj):
+    return 'AUTODEPEND__' + cache_obj.name
+
+def _shared_labels(caches):
+    """ Returns {cache_obj: set of the model labels shared for it}, with
+    one get_many() per backend. """
+    by_backend = {}
+    for cache_obj in caches:
+        by_backend.setdefault(id(cache_obj.cache), (cache_obj.cache, []))[1].append(cache_obj)
+    labels = {}
+    for backend, cache_objs in by_backend.itervalues():
+        fetched = backend.get_many([_shared_key(cache_obj) for cache_obj in cache_objs])
+        for cache_obj in cache_objs:
+            labels[cache_obj] = set(fetched.get(_shared_key(cache_obj)) or ())
+    return labels
+
+def share_inferred(cache_obj):
+    """ Adds the models cache_obj has seen used in this process to those
+    shared with other processes. """
+    key = _shared_key(cache_obj)
+    mine = set(map(_label, cache_obj.inferred_models))
+    shared = set(cache_obj.cache.get(key) or ())
+    if not shared.issuperset(mine):
+        cache_obj.cache.set(key, sorted(shared | mine), None)
+share_inferred.alters_data = True
+
+def add_auto_cache(cache_obj):
+    """ Makes changes to any model that cache_obj has been seen to use,
+    but doesn't declare, invalidate all of it. """
+    if not _auto_caches:
+        signals.post_save.connect(_instance_changed, weak=False,
+                                  dispatch_uid='argcache.autodepend.post_save')
+        signals.pre_delete.connect(_instance_changed, weak=False,
+                                   dispatch_uid='argcache.autodepend.pre_delete')
+        signals.m2m_changed.connect(_m2m_changed, weak=False,
+                                    dispatch_uid='argcache.autodepend.m2m_changed')
+    _auto_caches.append(cache_obj)
+add_auto_cache.alters_data = True
+
+def _instance_changed(sender, using=None, **kwargs):
+    model_changed(sender, using)
+
+def _m2m_changed(sender, action, using=None, **kwargs):
+    # sender is the m2m table, which changes without saving any rows
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        model_changed(sender, using)
+
+def model_changed(Model, using=None):
+    """ Invalidates the caches with auto_depend which any process has seen
+    use Model without declaring it. Costs a cache lookup per change, while
+    there are such caches. """
+    if not _auto_caches:
+        return
+    label = _label(Model)
+    for cache_obj, shared in _shared_labels(_auto_caches).iteritems():
+        mine = set(map(_label, cache_obj.inferred_models))
+        if not shared.issuperset(mine):
+            # another process's write won a race with ours
+            share_inferred(cache_obj)
+        if label in shared | mine and Model not in cache_obj.declared_models:
+            invalidate(cache_obj, {}, using)
+model_changed.alters_data = True
+
+def dependency_report():
+    """ For each cache with auto_depend, compares the models it was seen to
+    use with the models it declares dependencies on. Returns a list of
+    dicts, sorted by cache name, with lists of model labels:
+
+        inferred: used, and so depended on automatically if not declared
+        declared: declared with depend_on_model(), depend_on_row(), etc.
+        undeclared: used but not declared; add a (finer) declaration
+        unused: declared but never seen used; maybe stale
+
+    Only the first few computations in each process are watched, so unused
+    ones may just not have come up yet. """
+    report = []
+    shared = _shared_labels(_auto_caches)
+    for cache_obj in sorted(all_caches, key=lambda c: c.name):
+        if cache_obj not in shared:
+            continue
+        inferred = shared[cache_obj] | set(map(_label, cache_obj.inferred_models))
+        declared = set(map(_label, cache_obj.declared_models))
+        report.append({
+            'name': cache_obj.name,
+            'pretty_name': cache_obj.pretty_name,
+            'inferred': sorted(inferred),
+            'declared': sorted(declared),
+            'undeclared': sorted(inferred - declared),
+            'unused': sorted(declared - inferred),
+        })
+    return report
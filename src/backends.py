@@ -0,0 +1,85 @@
+""" Looking up cache backends by alias. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+from django.core.cache import cache, caches, DEFAULT_CACHE_ALIAS
+
+__all__ = ['get_cache', 'touch']
+
+class CacheProxy(object):
+    """ Like django.core.cache.cache, but for any alias: Django's cache
+    objects are per-thread, so we can't just hang on to one. """
+
+    def __init__(self, alias):
+        object.__setattr__(self, 'alias', alias)
+
+    def __getattr__(self, name):
+        return getattr(caches[self.alias], name)
+
+    def __setattr__(self, name, value):
+        return setattr(caches[self.alias], name, value)
+
+    def __delattr__(self, name):
+        return delattr(caches[self.alias], name)
+
+    def __contains__(self, key):
+        return key in caches[self.alias]
+
+    def __repr__(self):
+        return '<CacheProxy %s>' % self.alias
+
+_proxies = {DEFAULT_CACHE_ALIAS: cache}
+_proxies_lock = threading.Lock()
+
+def get_cache(cache_or_alias):
+    """ Returns the cache backend for an alias in settings.CACHES. Anything
+    else is assumed to be a backend already, and returned as is. The same
+    alias always gives the same object, so that requests to one backend can
+    be batched together. """
+    if not isinstance(cache_or_alias, basestring):
+        return cache_or_alias
+    with _proxies_lock:
+        if cache_or_alias not in _proxies:
+            caches[cache_or_alias] # fail early on unknown aliases
+            _proxies[cache_or_alias] = CacheProxy(cache_or_alias)
+        return _proxies[cache_or_alias]
+
+def touch(backend, key, timeout):
+    """ Pushes back the expiry of the value at key without changing it.
+    Returns whether it was there, or None if the backend can't do this. Uses
+    the backend's touch() if it has one (Django 2.1+); otherwise, for the
+    memcached backends, the client library's. There's no safe way to do it
+    with just get and set: setting the value we read could undo a delete
+    made in between. """
+    backend_touch = getattr(backend, 'touch', None)
+    if backend_touch is not None:
+        return backend_touch(key, timeout)
+    if getattr(backend, '_lib', None) is None:
+        # not memcached
+        return None
+    client = backend._cache
+    if not hasattr(client, 'touch'):
+        return None
+    return bool(client.touch(backend.make_key(key), backend.get_backend_timeout(timeout)))
@@ -0,0 +1,138 @@
+""" Deferred calls to cached functions, looked up together. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.utils.functional import SimpleLazyObject
+
+from .scope import current_scope
+
+__all__ = ['Deferred', 'defer_call', 'resolve_all']
+
+# Outside a request scope, a batch is cut off at this many calls, so that
+# handles which are never used can't pile up forever
+MAX_BATCH_CALLS = 1000
+
+_local = threading.local()
+
+# in results, for calls the batch didn't get to
+_UNRESOLVED = object()
+
+class Deferred(SimpleLazyObject):
+    """ A handle on the result of a cached function call, which resolves
+    every pending call in its batch the first time it is used, and then acts
+    like the result. """
+
+    def __init__(self, batch, index):
+        super(Deferred, self).__init__(lambda: batch.result(index))
+
+
+class _Batch(object):
+    """ Calls deferred since the last batch was resolved, in this thread
+    and request scope. holder is the scope (or thread local) which it is
+    the current batch of, until it is resolved. """
+
+    def __init__(self, holder):
+        self.holder = holder
+        self.calls = [] # (cache_obj, args, kwargs, arg_list)
+        self.results = None
+
+    def add(self, cache_obj, args, kwargs, arg_list):
+        self.calls.append((cache_obj, args, kwargs, arg_list))
+        return Deferred(self, len(self.calls) - 1)
+
+    def result(self, index):
+        if self.results is None:
+            try:
+                self.resolve()
+            except Exception:
+                # the calls it didn't get to are made one at a time below,
+                # so that one failure doesn't make us try all of them again
+                pass
+        value = self.results[index]
+        if value is _UNRESOLVED:
+            cache_obj, args, kwargs, arg_list = self.calls[index]
+            value = self.results[index] = cache_obj(*args, **kwargs)
+        return value
+
+    def resolve(self):
+        """ Looks up every call, with one request per cache backend, then
+        computes and stores the misses. """
+        if getattr(self.holder, 'batch', None) is self:
+            # later calls go in a new batch
+            self.holder.batch = None
+        results = self.results = [_UNRESOLVED] * len(self.calls)
+
+        groups = OrderedDict() # cache_obj -> indices of its calls
+        for i, (cache_obj, args, kwargs, arg_list) in enumerate(self.calls):
+            groups.setdefault(cache_obj, []).append(i)
+
+        lookups = []
+        requests = OrderedDict() # id(backend) -> (backend, keys)
+        for cache_obj, indices in groups.iteritems():
+            if cache_obj.disabled:
+                lookups.append(None)
+                continue
+            lookup = cache_obj._begin_lookup([self.calls[i][3] for i in indices])
+            lookups.append(lookup)
+            for backend, keys in lookup.requests():
+                requests.setdefault(id(backend), (backend, set()))[1].update(keys)
+
+        fetched = {}
+        for backend, keys in requests.itervalues():
+            fetched.update(backend.get_many(list(keys)))
+
+        for (cache_obj, indices), lookup in zip(groups.iteritems(), lookups):
+            arg_lists = [self.calls[i][3] for i in indices]
+            if lookup is None:
+                values, token_values, refresh = [cache_obj.CACHE_NONE] * len(indices), {}, set()
+            else:
+                values, token_values, refresh = cache_obj._finish_lookup(
+                    lookup, fetched, fill_tokens=True, refresh_stale=True)
+            calls = [(self.calls[i][1], self.calls[i][2]) for i in indices]
+            cache_obj._fill_misses(calls, arg_lists, values, token_values, refresh)
+            for i, value in zip(indices, values):
+                results[i] = value
+
+
+def _holder():
+    """ Where the current batch is kept: on the request scope, so that it
+    ends with the request, or else on the thread. """
+    scope = current_scope()
+    return _local if scope is None else scope
+
+def defer_call(cache_obj, args, kwargs, arg_list):
+    """ Adds a call to the current batch, returning a Deferred. """
+    holder = _holder()
+    batch = getattr(holder, 'batch', None)
+    if batch is None or (holder is _local and len(batch.calls) >= MAX_BATCH_CALLS):
+        batch = holder.batch = _Batch(holder)
+    return batch.add(cache_obj, args, kwargs, arg_list)
+
+def resolve_all():
+    """ Resolves the current batch now, if there is one. """
+    batch = getattr(_holder(), 'batch', None)
+    if batch is not None:
+        batch.resolve()
@@ -0,0 +1,120 @@
+""" Noticing which fields of a row actually changed when it is saved. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import copy
+
+from django.db.models import signals
+
+__all__ = ['FieldWatcher']
+
+class FieldWatcher(object):
+    """ Remembers the values of some fields of each instance of a Model as it
+    was loaded (or last saved), so that we can tell what a save changed.
+    ModelDispatcher passes on post_save and pre_delete.
+
+    Handlers are called as handler(instance, old_instance, using) when an
+    instance is saved with changes to any of their fields, or deleted.
+    old_instance is a copy of the instance with the changed fields as they
+    were when it was loaded or last saved, or None if it was just created (or
+    nothing changed). If the save gave update_fields, only those fields
+    count. """
+
+    def __init__(self, Model):
+        self.Model = Model
+        self.fields = {} # attname -> field
+        self.handlers = [] # (attnames, handler)
+        signals.post_init.connect(self.loaded, sender=Model, weak=False)
+
+    def watch(self, fields, handler):
+        attnames = set()
+        for name in fields:
+            field = self.Model._meta.get_field(name)
+            self.fields[field.attname] = field
+            attnames.add(field.attname)
+        self.handlers.append((attnames, handler))
+
+    def take_snapshot(self, instance, attnames=None):
+        """ Remembers the current values of the watched fields, or just of
+        attnames, the rest staying as they were. """
+        if attnames is None:
+            snapshot = instance._argcache_snapshot = {}
+            attnames = self.fields
+        else:
+            snapshot = instance.__dict__.setdefault('_argcache_snapshot', {})
+        # only what's already loaded; don't go fetching deferred fields
+        for attname in attnames:
+            if attname in self.fields and attname in instance.__dict__:
+                snapshot[attname] = instance.__dict__[attname]
+
+    def changed(self, instance, attnames):
+        """ Returns which of attnames have changed since the snapshot. """
+        snapshot = instance.__dict__.get('_argcache_snapshot')
+        if snapshot is None:
+            return attnames
+        return set(attname for attname in attnames
+                   if attname in instance.__dict__ and
+                   (attname not in snapshot or snapshot[attname] != instance.__dict__[attname]))
+
+    def old_instance(self, instance, changed):
+        """ Returns a copy of instance as it was before fields changed. """
+        snapshot = instance.__dict__.get('_argcache_snapshot') or {}
+        old = copy.copy(instance)
+        old._state = copy.copy(instance._state)
+        fields_cache = getattr(old._state, 'fields_cache', None)
+        if fields_cache is not None:
+            old._state.fields_cache = fields_cache = dict(fields_cache)
+        for attname in changed:
+            if attname not in snapshot:
+                continue
+            old.__dict__[attname] = snapshot[attname]
+            # forget the related object for the new value of a foreign key
+            field = self.fields[attname]
+            if field.is_relation:
+                old.__dict__.pop(field.get_cache_name(), None)
+                if fields_cache is not None:
+                    fields_cache.pop(field.get_cache_name(), None)
+        return old
+
+    def loaded(self, sender, instance, **kwargs):
+        self.take_snapshot(instance)
+
+    def saved(self, sender, instance, created, update_fields=None, using=None, **kwargs):
+        if update_fields is not None:
+            saved = set(self.Model._meta.get_field(name).attname for name in update_fields)
+        for attnames, handler in self.handlers:
+            if created:
+                handler(instance, None, using)
+                continue
+            if update_fields is not None:
+                attnames = attnames & saved
+            changed = self.changed(instance, attnames)
+            if changed:
+                handler(instance, self.old_instance(instance, changed), using)
+        # fields that weren't written still differ from the database
+        self.take_snapshot(instance, None if update_fields is None else saved)
+
+    def deleted(self, sender, instance, using=None, **kwargs):
+        for attnames, handler in self.handlers:
+            changed = self.changed(instance, attnames)
+            handler(instance, self.old_instance(instance, changed) if changed else None, using)
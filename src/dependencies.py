@@ -0,0 +1,141 @@
+""" The graph of dependencies between caches, for passing on invalidations. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import heapq
+import types
+from collections import OrderedDict
+
+from .invalidation import _key_set_id
+from .key_set import expand_key_sets
+from .registry import all_caches
+from .signals import cache_deleted, cache_deleted_many
+
+__all__ = ['add_dependency', 'compile_dependencies', 'propagate']
+
+# cache_obj -> its position in a topological order of the graph, or None if
+# the graph has changed since it was worked out
+_order = None
+
+def _cache_obj(obj):
+    """ Cached methods looked up on their class come out as unbound methods. """
+    if isinstance(obj, types.MethodType):
+        return obj.im_func
+    return obj
+
+def _path(start, end):
+    """ Returns a list of caches from start to end along dependencies, or
+    None if there's no way through. """
+    parents = {start: None}
+    stack = [start]
+    while stack:
+        cache_obj = stack.pop()
+        if cache_obj is end:
+            path = []
+            while cache_obj is not None:
+                path.append(cache_obj)
+                cache_obj = parents[cache_obj]
+            return path[::-1]
+        for dependent, mapping_func, filter in cache_obj.dependents:
+            if dependent not in parents:
+                parents[dependent] = cache_obj
+                stack.append(dependent)
+    return None
+
+def add_dependency(cache_obj, dependent, mapping_func, filter):
+    """ Makes invalidations of key sets of cache_obj pass on to dependent,
+    through mapping_func (see ArgCache.depend_on_cache). Raises ValueError
+    if that would make a cycle. """
+    global _order
+    cache_obj, dependent = _cache_obj(cache_obj), _cache_obj(dependent)
+    cycle = _path(dependent, cache_obj)
+    if cycle is not None:
+        raise ValueError("Cache dependency cycle: %s" %
+                         ' -> '.join([c.name for c in [cache_obj] + cycle]))
+    cache_obj.dependents.append((dependent, mapping_func, filter))
+    _order = None
+
+def compile_dependencies():
+    """ Works out an order in which to pass on invalidations, such that
+    every cache comes after everything it depends on. """
+    global _order
+    caches = list(all_caches)
+    seen = set(caches)
+    indegree = dict((cache_obj, 0) for cache_obj in caches)
+    for cache_obj in caches:
+        for dependent, mapping_func, filter in cache_obj.dependents:
+            if dependent not in seen:
+                seen.add(dependent)
+                caches.append(dependent)
+            indegree[dependent] = indegree.get(dependent, 0) + 1
+    ready = [cache_obj for cache_obj in caches if indegree[cache_obj] == 0]
+    order = {}
+    while ready:
+        cache_obj = ready.pop()
+        order[cache_obj] = len(order)
+        for dependent, mapping_func, filter in cache_obj.dependents:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                ready.append(dependent)
+    # add_dependency() doesn't allow cycles, so everything is in order
+    _order = order
+    return order
+
+def propagate(cache_obj, key_sets):
+    """
+    Tells everything that depends on cache_obj that key_sets of it were
+    deleted, and deletes whatever that maps to in each dependent cache, and
+    so on. Each cache is visited once, after everything it depends on, and
+    gets all of its key sets at once without duplicates, however many ways
+    they were reached.
+    """
+    order = _order
+    if order is None:
+        order = compile_dependencies()
+    pending = {cache_obj: OrderedDict((_key_set_id(key_set), key_set)
+                                      for key_set in expand_key_sets(key_sets))}
+    heap = [(order.get(cache_obj, -1), cache_obj)]
+    while heap:
+        position, current = heapq.heappop(heap)
+        key_sets = pending.pop(current).values()
+        if current is not cache_obj:
+            current.delete_key_sets(key_sets, send_signal=False)
+        if cache_deleted.has_listeners(current):
+            for key_set in key_sets:
+                cache_deleted.send(sender=current, key_set=key_set)
+        if cache_deleted_many.has_listeners(current):
+            cache_deleted_many.send(sender=current, key_sets=key_sets)
+        for dependent, mapping_func, filter in current.dependents:
+            for key_set in key_sets:
+                if not filter(**key_set):
+                    continue
+                new_key_sets = mapping_func(**key_set)
+                if new_key_sets is None:
+                    continue
+                bucket = pending.get(dependent)
+                if bucket is None:
+                    bucket = pending[dependent] = OrderedDict()
+                    heapq.heappush(heap, (order[dependent], dependent))
+                for new_key_set in expand_key_sets(new_key_sets):
+                    if new_key_set is not None:
+                        bucket.setdefault(_key_set_id(new_key_set), new_key_set)
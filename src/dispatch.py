@@ -0,0 +1,152 @@
+""" One receiver per model, for everything that depends on its rows. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from django.db.models import signals
+
+from .changes import FieldWatcher
+from .marinade import ref
+
+__all__ = ['dispatcher_for', 'instance_selector', 'fk_selector']
+
+_dispatchers = {} # Model -> ModelDispatcher
+
+class ModelDispatcher(object):
+    """
+    Receives post_save and pre_delete for one model, and calls every handler
+    that depends on it. Selectors and filters are called once per row, and
+    their results shared by every handler using the same function.
+
+    Model handlers are called as handler(using), and row handlers as
+    handler(key_sets, using) with what the selector chose.
+    """
+
+    def __init__(self, Model):
+        self.Model = Model
+        self.model_handlers = []
+        self.row_handlers = [] # (selector, filter, handler)
+        # row handlers which only see bulk changes, since the watcher calls
+        # them on saves which matter
+        self.bulk_row_handlers = []
+        self.watcher = None
+        signals.post_save.connect(self.saved, sender=Model, weak=False)
+        signals.pre_delete.connect(self.deleted, sender=Model, weak=False)
+
+    def add_model_handler(self, handler):
+        self.model_handlers.append(handler)
+
+    def add_row_handler(self, selector, filter, handler):
+        self.row_handlers.append((selector, filter, handler))
+
+    def add_fields_handler(self, fields, selector, filter, handler, changed_handler):
+        """ Like add_row_handler(), but saves are left to a FieldWatcher,
+        which calls changed_handler(instance, old_instance, using). """
+        if self.watcher is None:
+            self.watcher = FieldWatcher(self.Model)
+        self.watcher.watch(fields, changed_handler)
+        self.bulk_row_handlers.append((selector, filter, handler))
+
+    def _run(self, handlers, instance, using):
+        results = {} # selector or filter -> its result for instance
+        for selector, filter, handler in handlers:
+            if filter is not None:
+                if filter not in results:
+                    results[filter] = filter(instance)
+                if not results[filter]:
+                    continue
+            if selector not in results:
+                results[selector] = selector(instance)
+            key_sets = results[selector]
+            if key_sets is not None:
+                handler(key_sets, using)
+
+    def saved(self, sender, instance, using=None, **kwargs):
+        for handler in self.model_handlers:
+            handler(using)
+        self._run(self.row_handlers, instance, using)
+        if self.watcher is not None:
+            self.watcher.saved(sender, instance, using=using, **kwargs)
+
+    def deleted(self, sender, instance, using=None, **kwargs):
+        for handler in self.model_handlers:
+            handler(using)
+        self._run(self.row_handlers, instance, using)
+        if self.watcher is not None:
+            self.watcher.deleted(sender, instance, using=using, **kwargs)
+
+    def rows_changed(self, instances, using):
+        """ For changes which didn't send signals; instances is an iterable
+        of the changed rows. """
+        for handler in self.model_handlers:
+            handler(using)
+        handlers = self.row_handlers + self.bulk_row_handlers
+        if handlers:
+            for instance in instances:
+                self._run(handlers, instance, using)
+
+    def all_rows_changed(self, using):
+        """ For changes to rows we can't identify; everything that depends
+        on any row is invalidated. """
+        for handler in self.model_handlers:
+            handler(using)
+        for selector, filter, handler in self.row_handlers + self.bulk_row_handlers:
+            handler({}, using)
+
+def dispatcher_for(Model, create=True):
+    """ Returns the ModelDispatcher for Model, or None if there isn't one
+    and create is False. """
+    dispatcher = _dispatchers.get(Model)
+    if dispatcher is None and create:
+        dispatcher = _dispatchers[Model] = ModelDispatcher(Model)
+    return dispatcher
+
+# Selectors made from strings are shared, so that their results can be.
+_selectors = {}
+
+def instance_selector(param):
+    """ Returns a selector mapping param to the instance. """
+    key = (param,)
+    if key not in _selectors:
+        _selectors[key] = lambda instance: {param: instance}
+    return _selectors[key]
+
+def fk_selector(Model, fk_name, param):
+    """ Returns a selector mapping param to whatever the foreign key fk_name
+    of an instance of Model points to, without loading it. """
+    key = (Model, fk_name, param)
+    if key in _selectors:
+        return _selectors[key]
+    field = Model._meta.get_field(fk_name)
+    if not field.many_to_one:
+        raise ValueError('%s.%s is not a foreign key' % (Model.__name__, fk_name))
+    def selector(instance):
+        # the related model may not be loaded until now
+        if not field.related_fields[0][1].primary_key:
+            # the column doesn't hold the primary key, so we have to look
+            return {param: getattr(instance, fk_name)}
+        pk = getattr(instance, field.attname)
+        if pk is None:
+            return None
+        return {param: ref(field.related_model, pk)}
+    _selectors[key] = selector
+    return selector
@@ -24,11 +24,45 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import functools
 import inspect
+import threading
+import time
 import types
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
 
 from .argcache import ArgCache
+from .autodepend import record_queries, models_for_queries, add_auto_cache, share_inferred
+from .batch import defer_call
 from .marinade import describe_func, get_containing_class
 
+# How many threads compute things in the background (stale refreshes and
+# submit()), shared by all caches
+POOL_THREADS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(POOL_THREADS)
+        return _pool
+
+def _close_connections():
+    """ Don't leave connections open in the pool's threads. """
+    for conn in connections.all():
+        conn.close()
+
+class _Flight(object):
+    """ A computation in progress in this process, for other threads to wait on. """
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.value = None
+
 class ArgCacheDecorator(ArgCache):
     """ An ArgCache that gets its parameters from a function. """
 
@@ -53,8 +87,32 @@ class ArgCacheDecorator(ArgCache):
             return super(ArgCacheDecorator, cls).__new__(
                 cls, func_or_spec, spec=spec, **kwargs)
 
-    def __init__(self, func, spec=None, **kwargs):
-        """ Wrap func in a ArgCache. """
+    def __init__(self, func, spec=None, single_flight=False, lease_seconds=30,
+                 lease_wait_seconds=10, background_refresh=False, auto_depend=False,
+                 auto_depend_calls=5, **kwargs):
+        """
+        Wrap func in a ArgCache.
+
+        If single_flight is True, only one caller computes a missing value at
+        a time: other threads in this process wait for it, and other processes
+        wait (polling, for up to lease_wait_seconds) on a lease held in the
+        cache for up to lease_seconds, before giving up and computing it
+        themselves.
+
+        With stale_ttl, the caller that is to refresh a stale value does so
+        before returning, unless background_refresh is True, in which case it
+        returns the stale value and a background thread refreshes it.
+
+        If auto_depend is True, the queries run by the first auto_depend_calls
+        computations in each process are recorded, and the whole cache is
+        made to depend on each model whose table they use, unless some
+        dependency on that model was declared already. The models found are
+        kept in the cache, so that changes made by any process invalidate it;
+        this costs a cache lookup per change to any model. This is coarse, so
+        it's best used to find out what to declare; see
+        autodepend.dependency_report(). Queries run by other cached functions
+        are only seen when they miss, so declare depend_on_cache() for those.
+        """
 
         ## Keep the original function's name and docstring
         ## If the original function has any more-complicated attrs,
@@ -77,6 +135,20 @@ class ArgCacheDecorator(ArgCache):
 
         super(ArgCacheDecorator, self).__init__(name=name, params=params, **kwargs)
 
+        self.single_flight = single_flight
+        self.lease_seconds = lease_seconds
+        self.lease_wait_seconds = lease_wait_seconds
+        self.background_refresh = background_refresh
+        self._flights = {}
+        self._submitted = {}
+        self._flights_lock = threading.Lock()
+        self.auto_depend = auto_depend
+        self.auto_depend_calls = auto_depend_calls if auto_depend else 0
+        # models seen in the recorded queries
+        self.inferred_models = set()
+        if auto_depend:
+            add_auto_cache(self)
+
         # Apply cache directives, if any
         if spec is not None:
             for method in spec:
@@ -97,21 +169,202 @@ class ArgCacheDecorator(ArgCache):
 
         if use_cache:
             arg_list = self.arg_list_from(*args, **kwargs)
-            retVal = self.get(arg_list, default=self.CACHE_NONE)
-
-            if retVal is not self.CACHE_NONE:
-                return retVal
-
             if cache_only:
-                retVal = None
+                retVal = self.get(arg_list, default=None)
             else:
-                retVal = self.func(*args, **kwargs)
-                self.set(arg_list, retVal)
+                # Grab the tokens now, so that anything invalidated while we
+                # compute is still invalid after we store it.
+                values, token_values, refresh = self._lookup([arg_list])
+                retVal = values[0]
+                if retVal is self.CACHE_NONE:
+                    retVal = self._compute(arg_list, token_values, args, kwargs)
+                elif refresh:
+                    retVal = self._refresh(arg_list, retVal, token_values, args, kwargs)
         else:
             retVal = self.func(*args, **kwargs)
 
         return retVal
 
+    def _lookup(self, arg_lists):
+        """ Looks up arg_lists, returning the values (CACHE_NONE for misses),
+        the token values seen, and the indices of stale values to refresh. """
+        if self.disabled:
+            return [self.CACHE_NONE] * len(arg_lists), {}, set()
+        return self._get_many(arg_lists, fill_tokens=True, refresh_stale=True)
+
+    def _refresh(self, arg_list, stale_value, token_values, args, kwargs):
+        """ Recomputes a stale value, returning whatever should be served now. """
+        if self.background_refresh:
+            _get_pool().apply_async(self._background_refresh,
+                                    (arg_list, token_values, args, kwargs))
+            return stale_value
+        return self._compute_and_set(arg_list, token_values, args, kwargs)
+
+    def _background_refresh(self, arg_list, token_values, args, kwargs):
+        try:
+            self._compute_and_set(arg_list, token_values, args, kwargs)
+        finally:
+            _close_connections()
+
+    def _call(self, args, kwargs):
+        """ Calls the function, returning the result and how long it took. """
+        with self._flights_lock:
+            watch = self.auto_depend_calls > 0
+            if watch:
+                self.auto_depend_calls -= 1
+        if watch:
+            queries = []
+            start = time.time()
+            with record_queries(queries):
+                retVal = self.func(*args, **kwargs)
+            seconds = time.time() - start
+            self._add_inferred(models_for_queries(queries))
+            return retVal, seconds
+        start = time.time()
+        retVal = self.func(*args, **kwargs)
+        return retVal, time.time() - start
+
+    def _add_inferred(self, models):
+        """ Depends on each of models that we haven't already, in every
+        process; see autodepend.model_changed(). """
+        new = models - self.inferred_models
+        if not new:
+            return
+        self.inferred_models |= new
+        if settings.CACHE_DEBUG:
+            for Model in new - self.declared_models:
+                print "Inferred dependency of %s on %s" % (self.name, Model.__name__)
+        share_inferred(self)
+    _add_inferred.alters_data = True
+
+    def _compute_and_set(self, arg_list, token_values, args, kwargs):
+        """ Calls the function and stores the result. """
+        retVal, seconds = self._call(args, kwargs)
+        self.set(arg_list, retVal, token_values=token_values, compute_seconds=seconds)
+        return retVal
+
+    def _compute(self, arg_list, token_values, args, kwargs):
+        """ Computes and stores a value that was missing from the cache. """
+        if not self.single_flight:
+            return self._compute_and_set(arg_list, token_values, args, kwargs)
+
+        key = self.key(arg_list)
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.ok:
+                return flight.value
+            # it blew up; see for ourselves
+            return self._compute_and_set(arg_list, token_values, args, kwargs)
+
+        try:
+            flight.value = self._compute_leased(key, arg_list, token_values, args, kwargs)
+            flight.ok = True
+            return flight.value
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _compute_leased(self, key, arg_list, token_values, args, kwargs):
+        """ Computes a missing value, unless another process already is, in
+        which case wait for it to be stored. """
+        lease_key = 'LEASE__' + key
+        if self.cache.add(lease_key, 1, self.lease_seconds):
+            try:
+                return self._compute_and_set(arg_list, token_values, args, kwargs)
+            finally:
+                self.cache.delete(lease_key)
+
+        # Somebody else is computing it; wait with backoff
+        delay = 0.01
+        deadline = time.time() + self.lease_wait_seconds
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+            retVal, token_values = self.get_with_tokens(arg_list, default=self.CACHE_NONE)
+            if retVal is not self.CACHE_NONE:
+                return retVal
+            if self.cache.get(lease_key) is None:
+                # They gave up without storing anything
+                break
+
+        return self._compute_and_set(arg_list, token_values, args, kwargs)
+
+    def submit(self, *args, **kwargs):
+        """
+        Call the function (using the cache if possible) in a background
+        thread, so that the caller isn't blocked on the cache or the database.
+        Returns a multiprocessing.pool.AsyncResult; call its get() for the
+        value. Submissions with the same arguments made while one is still
+        running share its result.
+        """
+        key = self.key(self.arg_list_from(*args, **kwargs))
+        with self._flights_lock:
+            result = self._submitted.get(key)
+            if result is None:
+                # the worker can't remove this before we've added it, since
+                # it needs the lock too
+                result = self._submitted[key] = _get_pool().apply_async(
+                    self._run_submitted, (key, args, kwargs))
+            return result
+
+    def _run_submitted(self, key, args, kwargs):
+        try:
+            return self(*args, **kwargs)
+        finally:
+            with self._flights_lock:
+                del self._submitted[key]
+            _close_connections()
+
+    def map(self, iterable_of_args, use_cache=True):
+        """ Call the function on each tuple of positional arguments in
+        iterable_of_args, and return a list of the results. The cache is
+        checked for all of them with one request, and the misses are stored
+        back with one more. """
+        calls = [(tuple(args), {}) for args in iterable_of_args]
+        if not use_cache:
+            return [self.func(*args) for args, kwargs in calls]
+
+        arg_lists = [self.arg_list_from(*args) for args, kwargs in calls]
+        results, token_values, refresh = self._lookup(arg_lists)
+        self._fill_misses(calls, arg_lists, results, token_values, refresh)
+        return results
+
+    def defer(self, *args, **kwargs):
+        """ Returns a lazy handle on the result of calling the function, which
+        acts like the result itself once used. All the handles created
+        (by any cached function) in a request scope before one of them is
+        used are looked up together, in one request to the cache. """
+        return defer_call(self, args, kwargs, self.arg_list_from(*args, **kwargs))
+
+    def _fill_misses(self, calls, arg_lists, results, token_values, refresh):
+        """ Given the results of looking up arg_lists, computes the misses (and
+        refreshes) in place, using calls, a list of (args, kwargs). Each
+        distinct miss is computed once, and they're stored with one request. """
+        computed = {}
+        to_set = []
+        compute_seconds = []
+        for i, (args, kwargs) in enumerate(calls):
+            if i in refresh and self.background_refresh:
+                self._refresh(arg_lists[i], results[i], token_values, args, kwargs)
+            elif results[i] is self.CACHE_NONE or i in refresh:
+                key = self.key(arg_lists[i])
+                if key not in computed:
+                    computed[key], seconds = self._call(args, kwargs)
+                    to_set.append((arg_lists[i], computed[key]))
+                    compute_seconds.append(seconds)
+                results[i] = computed[key]
+        self.set_many(to_set, token_values=token_values, compute_seconds=compute_seconds)
+
     # make bound member functions work...
     def __get__(self, obj, objtype=None):
         """ Python member functions are such hacks... :-D """
@@ -136,3 +389,4 @@ depend_on_row = directive_maker(ArgCache.depend_on_row)
 depend_on_cache = directive_maker(ArgCache.depend_on_cache)
 depend_on_m2m = directive_maker(ArgCache.depend_on_m2m)
 ensure_token = directive_maker(ArgCache.get_or_create_token)
+ensure_path_token = directive_maker(ArgCache.get_or_create_path_token)
@@ -0,0 +1,217 @@
+""" Collecting invalidations from model changes and making them together. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet
+
+from .dispatch import dispatcher_for
+from .key_set import is_wildcard, expand_key_sets
+from .marinade import marinade_dish
+
+__all__ = ['invalidate', 'invalidation_batch', 'invalidate_rows',
+           'InvalidatingQuerySet', 'InvalidatingManager']
+
+# How many rows invalidate_rows() loads at once
+CHUNK_SIZE = 1000
+
+_local = threading.local()
+
+def _key_set_id(key_set):
+    """ Returns something hashable that is the same for key sets that delete
+    the same things. """
+    return tuple(sorted((param, None if is_wildcard(value) else marinade_dish(value))
+                        for param, value in key_set.iteritems()))
+
+class _Invalidations(object):
+    """ Key sets waiting to be deleted, without duplicates. """
+
+    def __init__(self):
+        self.depth = 0
+        self.key_sets = OrderedDict() # (cache_obj, key set id) -> key_set
+
+    def add(self, cache_obj, key_sets):
+        for key_set in expand_key_sets(key_sets):
+            self.key_sets.setdefault((cache_obj, _key_set_id(key_set)), key_set)
+
+    def flush(self):
+        """ Deletes everything collected so far, one cache at a time. """
+        groups = OrderedDict() # cache_obj -> key sets
+        for (cache_obj, key_set_id), key_set in self.key_sets.iteritems():
+            groups.setdefault(cache_obj, []).append(key_set)
+        self.key_sets.clear()
+        for cache_obj, key_sets in groups.iteritems():
+            cache_obj.delete_key_sets(key_sets)
+
+def _on_commit_batch(using):
+    """ Returns the invalidations to make when the transaction in progress on
+    database using commits, or None if there isn't one (or we can't wait). """
+    if not settings.ARGCACHE_ON_COMMIT or not hasattr(transaction, 'on_commit'):
+        return None
+    connection = connections[using]
+    if not connection.in_atomic_block:
+        return None
+    pending = getattr(_local, 'on_commit', None)
+    if pending is None:
+        pending = _local.on_commit = {}
+    batch = pending.get(using)
+    # if it's no longer waiting, the transaction it was waiting for has
+    # committed or been rolled back, so start again
+    if batch is None or not any(func == batch.flush for sids, func in connection.run_on_commit):
+        batch = pending[using] = _Invalidations()
+        transaction.on_commit(batch.flush, using)
+    return batch
+
+def invalidate(cache_obj, key_sets, using=None):
+    """
+    Deletes key_sets from cache_obj (as cache_obj.delete_key_sets() does),
+    because of a change to database using.
+
+    Inside a transaction, this waits until the transaction commits, so that
+    nobody recomputes anything from the old data in the meantime, and does
+    nothing if it is rolled back. Otherwise it waits until the innermost
+    invalidation_batch ends, if there is one, or else happens now. Either
+    way, a key set that is deleted several times before then is only deleted
+    once.
+    """
+    if using is None:
+        using = DEFAULT_DB_ALIAS
+    batch = _on_commit_batch(using)
+    if batch is None:
+        batch = getattr(_local, 'batch', None)
+    if batch is None:
+        cache_obj.delete_key_sets(key_sets)
+    else:
+        batch.add(cache_obj, key_sets)
+
+class invalidation_batch(object):
+    """
+    Context manager for a batch of invalidations: those caused by model
+    changes made within it are collected, without duplicates, and made
+    together when it exits. This is useful for bulk updates run outside a
+    transaction (inside one, invalidations already wait for the commit).
+
+    Batches nest; the outermost one wins.
+    """
+
+    def __enter__(self):
+        batch = getattr(_local, 'batch', None)
+        if batch is None:
+            batch = _local.batch = _Invalidations()
+        batch.depth += 1
+        return batch
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        batch = _local.batch
+        batch.depth -= 1
+        if batch.depth == 0:
+            _local.batch = None
+            # whatever changed has changed, even if something went wrong
+            batch.flush()
+
+def _instances(Model, rows, using, chunk_size):
+    """ Iterates over the instances of Model in rows (a QuerySet, or instances
+    and primary keys), loading at most chunk_size at a time. """
+    if isinstance(rows, QuerySet):
+        rows = rows.values_list('pk', flat=True).iterator()
+    pks = []
+    for row in rows:
+        if isinstance(row, models.Model):
+            yield row
+            continue
+        pks.append(row)
+        if len(pks) >= chunk_size:
+            for instance in Model._base_manager.using(using).filter(pk__in=pks).iterator():
+                yield instance
+            pks = []
+    if pks:
+        for instance in Model._base_manager.using(using).filter(pk__in=pks).iterator():
+            yield instance
+
+def invalidate_rows(Model, rows, using=None, chunk_size=CHUNK_SIZE):
+    """
+    Invalidates everything that depends (by depend_on_row or
+    depend_on_model) on rows of Model, for changes that don't send the
+    usual signals, such as QuerySet.update(), bulk_create() or raw SQL.
+
+    rows is a QuerySet, or an iterable of instances or primary keys. Rows
+    are loaded chunk_size at a time, and the invalidations are made together.
+    If selectors look at anything being changed, call this both before and
+    after the change; rows being deleted must be invalidated beforehand.
+    """
+    from .autodepend import model_changed
+    if using is None:
+        using = rows.db if isinstance(rows, QuerySet) else DEFAULT_DB_ALIAS
+    with invalidation_batch():
+        model_changed(Model, using)
+        dispatcher = dispatcher_for(Model, create=False)
+        if dispatcher is not None:
+            dispatcher.rows_changed(_instances(Model, rows, using, chunk_size), using)
+
+class InvalidatingQuerySet(QuerySet):
+    """ A QuerySet whose update() and bulk_create() invalidate caches, like
+    save() does. """
+
+    def update(self, **kwargs):
+        # a chunk of rows at a time, in order of primary key, so the rows
+        # left to do still match even if the update changes what we filter by
+        rows = 0
+        last = None
+        # the batch ends after the commit, so nobody can recompute from the
+        # old rows once the invalidations are made
+        with invalidation_batch(), transaction.atomic(using=self.db):
+            while True:
+                chunk = self.order_by('pk')
+                if last is not None:
+                    chunk = chunk.filter(pk__gt=last)
+                pks = list(chunk.values_list('pk', flat=True)[:CHUNK_SIZE])
+                if not pks:
+                    break
+                last = pks[-1]
+                invalidate_rows(self.model, pks, self.db)
+                rows += super(InvalidatingQuerySet, self.filter(pk__in=pks)).update(**kwargs)
+                invalidate_rows(self.model, pks, self.db)
+        return rows
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super(InvalidatingQuerySet, self).bulk_create(objs, *args, **kwargs)
+        if any(obj.pk is None for obj in objs):
+            # the backend didn't tell us the new rows' primary keys, so we
+            # can't tell exactly what they affect
+            from .autodepend import model_changed
+            with invalidation_batch():
+                model_changed(self.model, self.db)
+                dispatcher = dispatcher_for(self.model, create=False)
+                if dispatcher is not None:
+                    dispatcher.all_rows_changed(self.db)
+        else:
+            invalidate_rows(self.model, objs, self.db)
+        return objs
+
+class InvalidatingManager(models.Manager.from_queryset(InvalidatingQuerySet)):
+    """ A Manager for InvalidatingQuerySets. """
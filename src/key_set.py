@@ -22,7 +22,9 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-__all__ = ['wildcard', 'is_wildcard']
+import itertools
+
+__all__ = ['wildcard', 'is_wildcard', 'any_of', 'subtree']
 
 class WildcardType(object):
     """
@@ -93,3 +95,59 @@ def specifies_key(key_set, key):
 def token_list_for(key_set):
     """ Given me a list of interesting arguments for key_set. """
     return [key for key,val in key_set.items() if not is_wildcard(val)]
+
+class any_of(object):
+    """
+    In a key set, stands for each of several values: {'self': any_of([r1,
+    r2])} is the same as [{'self': r1}, {'self': r2}]. (A plain list is a
+    single value, since arguments can be lists.)
+    """
+
+    def __init__(self, values):
+        self.values = list(values)
+
+    def __repr__(self):
+        return 'any_of(%r)' % (self.values,)
+
+def path_parts(path):
+    """ Splits a path argument into its components. A path is a list or
+    tuple of components, or a string separated by slashes. """
+    if isinstance(path, basestring):
+        return [part for part in path.split('/') if part]
+    return list(path)
+
+class subtree(object):
+    """
+    In a key set, stands for every path at or below path: {'path':
+    subtree('a/b')} covers 'a/b', 'a/b/c' and so on, but not 'a/bc'. Needs a
+    path token on that parameter; see ArgCache.get_or_create_path_token().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = path_parts(path)
+
+    def __repr__(self):
+        return 'subtree(%r)' % (self.path,)
+
+def is_subtree(obj):
+    """ Is the given object a subtree? """
+    return isinstance(obj, subtree)
+
+def expand_key_sets(list_or_set):
+    """ Iterates over the key sets in one or multiple (including nested
+    lists) key sets, expanding any_of()s. """
+    if isinstance(list_or_set, list):
+        for item in list_or_set:
+            for key_set in expand_key_sets(item):
+                yield key_set
+        return
+    key_set = list_or_set
+    multi = [key for key, value in key_set.iteritems() if isinstance(value, any_of)]
+    if not multi:
+        yield key_set
+        return
+    for values in itertools.product(*[key_set[key].values for key in multi]):
+        expanded = dict(key_set)
+        expanded.update(zip(multi, values))
+        yield expanded
@@ -0,0 +1,148 @@
+""" In-process caches in front of the cache backend. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle as pickle
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ['LocalCache', 'token_snapshot']
+
+# How many token values to remember locally, across all caches. Tokens are
+# tiny, so this can be generous.
+TOKEN_SNAPSHOT_ENTRIES = 10000
+
+class LocalCache(object):
+    """ A bounded, thread-safe LRU mapping, for keeping recently used cache
+    entries in this process. The size can be limited in entries, in (pickled)
+    bytes, or both.
+
+    Values are shared between everyone who gets them, rather than unpickled
+    afresh as they are from a real cache, so they must not be mutated. """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data = OrderedDict() # key -> (value, size, expires), oldest first
+        self._lock = threading.Lock()
+
+    def _size(self, value):
+        if self.max_bytes is None:
+            return 0
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return default
+            if item[2] is not None and item[2] <= time.time():
+                self.total_bytes -= item[1]
+                return default
+            # mark as most recently used
+            self._data[key] = item
+            return item[0]
+
+    def get_many(self, keys):
+        ans_dict = {}
+        for key in keys:
+            item = self.get(key, self)
+            if item is not self:
+                ans_dict[key] = item
+        return ans_dict
+
+    def set(self, key, value, timeout=None):
+        size = self._size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            expires = time.time() + timeout if timeout is not None else None
+            self._data[key] = (value, size, expires)
+            self.total_bytes += size
+            # evict least recently used
+            while ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                   (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                _, (_, old_size, _) = self._data.popitem(last=False)
+                self.total_bytes -= old_size
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.iteritems():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TokenSnapshot(object):
+    """ Token values recently read by this process, so that checking entries
+    of a LocalCache can skip the backend entirely for a short while. A token
+    invalidated by another process may be trusted for up to the ttl passed to
+    get_many(); invalidations in this process are seen immediately. """
+
+    def __init__(self, max_entries=TOKEN_SNAPSHOT_ENTRIES):
+        self._values = LocalCache(max_entries=max_entries)
+
+    def get_many(self, keys, ttl):
+        """ Returns the token values for keys that were read within ttl seconds. """
+        ans_dict = {}
+        if not ttl:
+            return ans_dict
+        oldest = time.time() - ttl
+        for key, (value, read_at) in self._values.get_many(keys).iteritems():
+            if read_at >= oldest:
+                ans_dict[key] = value
+        return ans_dict
+
+    def set_many(self, data):
+        now = time.time()
+        for key, value in data.iteritems():
+            self._values.set(key, (value, now))
+
+    def delete(self, key):
+        self._values.delete(key)
+
+    def clear(self):
+        self._values.clear()
+
+token_snapshot = TokenSnapshot()
@@ -51,25 +51,124 @@ def describe_func(func, class_name=None):
         else:
             return '%s.%s.%s' % (func.__module__.rstrip('.'), class_name, func.__name__)
 
+class ref(object):
+    """
+    Stands in for the instance of model with primary key pk, as an argument
+    or in a key set, without loading it: it marinades just like the
+    instance. Other attributes are looked up on the instance, which is only
+    loaded if they are needed. For example,
+
+        depend_on_row(Article, lambda article: {'self': ref(Reporter, article.reporter_id)})
+
+    doesn't need a query to look up article.reporter.
+    """
+
+    def __init__(self, model, pk):
+        self.model = model
+        self.pk = pk
+        self._instance = None
+
+    @property
+    def instance(self):
+        if self._instance is None:
+            self._instance = self.model._default_manager.get(pk=self.pk)
+        return self._instance
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == '_instance':
+            raise AttributeError(name)
+        return getattr(self.instance, name)
+
+    def __marinade__(self):
+        return force_str(self.pk)
+
+    def __eq__(self, other):
+        if isinstance(other, ref):
+            return self.model is other.model and self.pk == other.pk
+        return isinstance(other, self.model) and other.pk == self.pk
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __repr__(self):
+        return 'ref(%s, %r)' % (describe_class(self.model), self.pk)
+
+def _marinade_queryset(arg):
+    return marinade_dish(list(arg))
+
+def _marinade_list(arg):
+    return '[%s]' % ','.join([marinade_dish(item) for item in arg])
+
+def _marinade_model(arg):
+    # ESPUsers are also instances of AnonymousUser, but might not be
+    # anonymous.
+    if arg.id is None and (not isinstance(arg, AnonymousUser) or
+                           not arg.is_anonymous()):
+        import random
+        # TODO: Make this log something
+        print "PASSING UNSAVED MODEL!!! ERROR!!! CACHING CODE SHOULD NOT BE ENABLED!!!"
+        # Do the right thing anyway
+        return str(random.randint(0,999999))
+    return str(arg.id)
+
+def _marinade_method(arg):
+    return arg.__marinade__()
+
+# the types marinade_dish() has always known about, in the order it checks
+_BUILTIN_MARINADES = [
+    (QuerySet, _marinade_queryset),
+    (list, _marinade_list),
+    (Model, _marinade_model),
+    (type, describe_class),
+]
+
+# type -> how to marinade its instances, and its subclasses' unless they
+# have their own __marinade__; see register_marinade()
+_marinades = {}
+
+# exact type -> how to marinade it, filled in as types are seen
+_dispatch = {}
+
+def _reset_dispatch():
+    _dispatch.clear()
+    # same as force_str, but quicker; subclasses might have __marinade__
+    _dispatch.update({int: str, long: str})
+_reset_dispatch()
+
+def register_marinade(cls, func):
+    """ Marinade instances of cls, and of its subclasses, with func, which
+    should return a str. For types you can't give a __marinade__ method. """
+    _marinades[cls] = func
+    _reset_dispatch()
+
+def _find_marinade(arg, cls):
+    """ Works out how to marinade arg, whose class is cls. """
+    own_method = False
+    for base in inspect.getmro(cls):
+        if base in _marinades:
+            return _marinade_method if own_method else _marinades[base]
+        if '__marinade__' in vars(base):
+            own_method = True
+    for base, marinade in _BUILTIN_MARINADES:
+        if isinstance(arg, base):
+            return marinade
+    if hasattr(arg, '__marinade__'):
+        return _marinade_method
+    return force_str
+
 # It's kinda like pickling, but not quite
 def marinade_dish(arg):
-    if isinstance(arg, QuerySet):
-        return marinade_dish(list(arg))
-    if isinstance(arg, list):
-        return '[%s]' % ','.join([marinade_dish(item) for item in arg])
-    if isinstance(arg, Model):
-        # ESPUsers are also instances of AnonymousUser, but might not be
-        # anonymous.
-        if arg.id is None and (not isinstance(arg, AnonymousUser) or
-                               not arg.is_anonymous()):
-            import random
-            # TODO: Make this log something
-            print "PASSING UNSAVED MODEL!!! ERROR!!! CACHING CODE SHOULD NOT BE ENABLED!!!"
-            # Do the right thing anyway
-            return str(random.randint(0,999999))
-        return str(arg.id)
-    if isinstance(arg, type):
-        return describe_class(arg)
-    if hasattr(arg, '__marinade__'):
-        return arg.__marinade__()
-    return force_str(arg)
+    """ Turns arg into a str for use in a cache key. """
+    cls = type(arg)
+    marinade = _dispatch.get(cls)
+    if marinade is None:
+        real_cls = getattr(arg, '__class__', cls)
+        if real_cls is not cls:
+            # a proxy, like SimpleLazyObject (or an old-style instance),
+            # which might stand for anything, so don't remember
+            return _find_marinade(arg, real_cls)(arg)
+        _dispatch[cls] = marinade = _find_marinade(arg, cls)
+    return marinade(arg)
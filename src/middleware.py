@@ -0,0 +1,56 @@
+""" Middleware to memoize cache lookups within each request. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from .scope import request_scope
+
+__all__ = ['ArgCacheMiddleware']
+
+class ArgCacheMiddleware(object):
+    """ Opens a request_scope around each request. Works both as an old-style
+    (MIDDLEWARE_CLASSES) and a new-style (MIDDLEWARE) middleware. """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_scope(fresh=True):
+            return self.get_response(request)
+
+    def process_request(self, request):
+        request._argcache_scope = request_scope(fresh=True)
+        request._argcache_scope.__enter__()
+
+    def process_exception(self, request, exception):
+        self._end_scope(request)
+
+    def process_response(self, request, response):
+        self._end_scope(request)
+        return response
+
+    def _end_scope(self, request):
+        # process_request doesn't run if an earlier middleware responded
+        scope = getattr(request, '_argcache_scope', None)
+        if scope is not None:
+            del request._argcache_scope
+            scope.__exit__(None, None, None)
@@ -37,7 +37,9 @@ def dump_all_caches():
 
 def _finalize_caches():
     from .queued import do_all_pending
+    from .dependencies import compile_dependencies
     do_all_pending()
+    compile_dependencies()
     if settings.CACHE_DEBUG:
         print "Initialized caches"
 
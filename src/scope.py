@@ -0,0 +1,107 @@
+""" Per-request memoization of cache lookups. """
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of ArgCache.
+Copyright (c) 2015 by the individual contributors
+  (see AUTHORS file)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+__all__ = ['request_scope', 'current_scope', 'remember', 'forget']
+
+_local = threading.local()
+
+class RequestScope(object):
+    """ Everything read from or written to the cache backends during one
+    request, so that it need only be fetched once. Values are shared rather
+    than unpickled afresh, so they must not be mutated. """
+
+    def __init__(self):
+        self.depth = 0
+        self._data = {} # (id(backend), key) -> value
+        # calls deferred in this scope and not yet looked up; see batch.py
+        self.batch = None
+
+    def get_many(self, cache, keys):
+        """ Returns whatever we already know of keys on the backend cache. """
+        cache_id = id(cache)
+        ans_dict = {}
+        for key in keys:
+            value = self._data.get((cache_id, key), self)
+            if value is not self:
+                ans_dict[key] = value
+        return ans_dict
+
+    def set_many(self, cache, data):
+        cache_id = id(cache)
+        for key, value in data.iteritems():
+            self._data[(cache_id, key)] = value
+
+    def delete_many(self, cache, keys):
+        cache_id = id(cache)
+        for key in keys:
+            self._data.pop((cache_id, key), None)
+
+def current_scope():
+    """ Returns the active RequestScope for this thread, if any. """
+    return getattr(_local, 'scope', None)
+
+def remember(cache, data):
+    """ Records values just read from or written to cache, if in a scope. """
+    scope = current_scope()
+    if scope is not None:
+        scope.set_many(cache, data)
+
+def forget(cache, keys):
+    """ Records that keys were deleted from cache, if in a scope. """
+    scope = current_scope()
+    if scope is not None:
+        scope.delete_many(cache, keys)
+
+class request_scope(object):
+    """
+    Context manager for a request scope: within it, tokens and values read
+    from the cache are remembered and not fetched again, and invalidations
+    made within it update what is remembered. Invalidations made by other
+    processes in the meantime are not seen until the scope ends.
+
+    Scopes nest; the outermost one wins. With fresh=True, any scope left
+    open on this thread (by a request that never finished, say) is dropped
+    and a new one started instead. ArgCacheMiddleware opens a fresh one for
+    each request.
+    """
+
+    def __init__(self, fresh=False):
+        self.fresh = fresh
+
+    def __enter__(self):
+        scope = None if self.fresh else current_scope()
+        if scope is None:
+            scope = _local.scope = RequestScope()
+        scope.depth += 1
+        self.scope = scope
+        return scope
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        scope = self.scope
+        scope.depth -= 1
+        # unless a fresh scope has replaced ours already
+        if scope.depth == 0 and current_scope() is scope:
+            _local.scope = None
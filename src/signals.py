@@ -22,7 +22,7 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-__all__ = ['table_dirty', 'cache_deleted']
+__all__ = ['table_dirty', 'cache_deleted', 'cache_deleted_many']
 
 
 from django.dispatch import Signal
@@ -34,3 +34,6 @@ from django.dispatch import Signal
 
 """ Emitted when a cache is deleted. """
 cache_deleted = Signal(providing_args=['key_set'])
+
+""" Emitted once for all of the key sets deleted from a cache together. """
+cache_deleted_many = Signal(providing_args=['key_sets'])
@@ -22,16 +22,29 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import hashlib
 import random
+import time
+from collections import OrderedDict
 
+from django.conf import settings
 from django.core.cache import cache
 
+from .backends import touch
+from .local import LocalCache, token_snapshot, TOKEN_SNAPSHOT_ENTRIES
 from .marinade import marinade_dish
-from .key_set import has_wildcard, specifies_key
+from .scope import remember, forget
+from .key_set import has_wildcard, specifies_key, path_parts
 
-__all__ = ['Token', 'ExternalToken']
+__all__ = ['Token', 'PathToken', 'ExternalToken', 'digest_token_values', 'delete_tokens']
 
-global_cache_time = 86400
+# Token keys which this process has recently created or extended, and so
+# which are known to have at least half their lifetime left
+_fresh_tokens = LocalCache(max_entries=TOKEN_SNAPSHOT_ENTRIES)
+
+def digest_token_values(values):
+    """ Hashes a list of token values into one fixed-size signature. """
+    return hashlib.md5(':'.join([str(value) for value in values])).digest()
 
 # Tokens and handles are separated so we can do things like share model-row
 # tokens, etc. In general, a token represents an event.
@@ -46,9 +59,22 @@ class Token(object):
     of it as an authentication cookie. Tokens are parametrized by a subset of
     the original cache's arguments. """
 
-    def __init__(self, name, provided_params, cache=cache):
+    def __init__(self, name, provided_params, cache=cache, incr=False, timeout=None, jitter=None):
         self.name = name
+        self._key_prefix = 'TOKEN__' + name + '|'
         self.cache = cache
+        # If incr is True, token values are version numbers, which are
+        # incremented to invalidate, instead of random numbers which are
+        # deleted and regenerated
+        self.incr = incr
+        # Tokens live for timeout seconds, less up to a fraction jitter of
+        # that, so that tokens made together don't all expire together
+        if timeout is None:
+            timeout = settings.ARGCACHE_TOKEN_TIMEOUT
+        if jitter is None:
+            jitter = settings.ARGCACHE_TOKEN_JITTER
+        self.timeout = timeout
+        self.jitter = jitter
         # This should be immutable, also I want to hash it
         if isinstance(provided_params, list):
             provided_params = tuple(provided_params)
@@ -91,7 +117,13 @@ class Token(object):
 
     def key_filt(self, filt):
         """ Given filtered arguments, returns a key."""
-        return 'TOKEN__' + self.name + '|' + ':'.join([marinade_dish(arg) for arg in filt])
+        return self._key_prefix + ':'.join([marinade_dish(arg) for arg in filt])
+
+    def key_plan(self):
+        """ Returns (prefix, indices) such that the key for some arguments is
+        prefix followed by the marinaded arguments at indices, joined with
+        colons; or None if that's not how this token makes keys. """
+        return self._key_prefix, self.provided_params
 
     def delete_key_set(self, key_set, send_signal=True):
         """ Given a filtered set of arguments, deletes things. """
@@ -103,13 +135,24 @@ class Token(object):
         # Check if this is a single item...
         if has_wildcard(filt):
             raise ValueError("Tried to delete an argument set with a wildcard.")
-        self.cache.delete(self.key_filt(filt))
+        delete_tokens([(self, self.key_filt(filt))])
         # Send the signal...
         if send_signal:
             key_set = self.key_set_from_filt(filt)
             self.cache_obj.send(key_set=key_set)
     delete_filt.alters_data = True
 
+    def bump(self, key):
+        """ Invalidates the incr token value at key. """
+        try:
+            remember(self.cache, {key: self.cache.incr(key)})
+        except ValueError:
+            # It's gone already, so everything that used it is invalid;
+            # make a fresh one to save the next reader the trouble
+            forget(self.cache, [key])
+            self.new_value(key)
+    bump.alters_data = True
+
     def value_args(self, args):
         """ Returns a token value, based on function arguments. """
         return self.value_filt(self._filter_args(args))
@@ -122,13 +165,99 @@ class Token(object):
         """ Returns and, if necessary, creates a token value at this key. """
         token = self.cache.get(key)
         if token is None:
+            token = self.new_value(key)
+        return token
+
+    def new_value(self, key):
+        """ Creates a token value at this key, which was just seen missing. """
+        if self.incr:
+            # Start from the time in microseconds, so that if this token is
+            # lost and recreated, the new versions are beyond all the old ones
+            token = int(time.time() * 1000000)
+        else:
             token = random.randint(0, 1048575)
-            self.cache.add(key, token, global_cache_time)
+        timeout = self.lifetime()
+        if self.cache.add(key, token, timeout):
+            if timeout is not None:
+                _fresh_tokens.set(key, True, timeout / 2)
+        else:
+            # Somebody beat us to it; use theirs
+            token = self.cache.get(key, token)
+        remember(self.cache, {key: token})
         return token
 
+    def lifetime(self):
+        """ Returns how long a token value set now should live. """
+        if self.timeout is None:
+            return None
+        return int(self.timeout * (1 - random.random() * self.jitter))
+
+    def extend(self, key):
+        """ Pushes back the expiry of a token value that was just read, unless
+        we know it has plenty of time left. This keeps tokens that are in use
+        from expiring (and taking everything that depends on them with them).
+        Needs memcached, or a backend with touch(); otherwise tokens just
+        expire. See backends.touch(). """
+        if self.timeout is None or _fresh_tokens.get(key):
+            return
+        timeout = self.lifetime()
+        touched = touch(self.cache, key, timeout)
+        # if this backend can't touch, don't keep asking
+        if touched or touched is None:
+            _fresh_tokens.set(key, True, timeout / 2)
+
     def __str__(self):
         return 'Token %s' % self.name
 
+def delete_tokens(tokens_and_keys):
+    """ Invalidates the token values at each of a list of (token, key)
+    pairs, deleting them with one request per backend (incr tokens, which
+    Django can't increment in bulk, take one each). Doesn't send signals. """
+    to_delete = OrderedDict() # id(backend) -> (backend, keys)
+    for token, key in tokens_and_keys:
+        token_snapshot.delete(key)
+        _fresh_tokens.delete(key)
+        if token.incr:
+            token.bump(key)
+        else:
+            to_delete.setdefault(id(token.cache), (token.cache, set()))[1].add(key)
+    for backend, keys in to_delete.itervalues():
+        keys = list(keys)
+        backend.delete_many(keys)
+        forget(backend, keys)
+
+class PathToken(Token):
+    """ One level of a token on a path-valued parameter, for deleting whole
+    subtrees. An entry gets one PathToken per level, down to some bounded
+    depth, each keyed on the prefix of its path that long (or the whole
+    path, if it's shorter). All levels share a name, so the key for a prefix
+    is the same whichever level it came from, and deleting that one key
+    invalidates everything at or below the prefix. """
+
+    def __init__(self, name, provided_params, path_index, level, **kwargs):
+        super(PathToken, self).__init__(name, provided_params, **kwargs)
+        # path_index indexes the cache's params, like provided_params
+        self.path_index = path_index
+        self.level = level
+
+    def _filter_args(self, args):
+        """ Returns the arguments this Token cares about, with the path cut
+        down to this token's level. """
+        filt = []
+        for i in self.provided_params:
+            if i == self.path_index:
+                filt.append(path_parts(args[i])[:self.level])
+            else:
+                filt.append(args[i])
+        return filt
+
+    def key_plan(self):
+        """ Our keys use part of the path, not the marinaded argument. """
+        return None
+
+    def __str__(self):
+        return 'Token %s (level %d)' % (self.name, self.level)
+
 # A proxy token of sorts...
 # kind of a hack... :-/
 class SingleEntryToken(Token):
@@ -136,7 +265,8 @@ class SingleEntryToken(Token):
         self.cache_obj = cache_obj
         super(SingleEntryToken, self).__init__(name=cache_obj.name + "FAKE",
                                                provided_params=range(len(cache_obj.params)),
-                                               cache=cache_obj.cache)
+                                               cache=cache_obj.cache,
+                                               incr=cache_obj.incr_tokens)
 
     def delete_filt(self, filt, send_signal=True):
         """ Given a filtered set of arguments, deletes things. """
@@ -24,9 +24,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf.urls import url
 
-from .views import view_all, flush
+from .views import view_all, flush, dependencies
 
 urlpatterns = [
     url(r'^view_all/?$', view_all, name='view_all'),
-    url(r'^flush/([0-9]+)/?$', flush, name='flush')
+    url(r'^flush/([0-9]+)/?$', flush, name='flush'),
+    url(r'^dependencies/?$', dependencies, name='dependencies'),
 ]
@@ -22,6 +22,7 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from .autodepend import dependency_report
 from .registry import all_caches
 from django.shortcuts import redirect, render_to_response
 from django.core.urlresolvers import reverse
@@ -33,7 +34,7 @@ def view_all(request):
     if not request.user.is_staff:
         return HttpResponseForbidden()
     caches = sorted(all_caches, key=lambda c: c.name)
-    cache_data = [{'pretty_name': cache.pretty_name, 'hit_count': cache.hit_count, 'miss_count': cache.miss_count} for cache in caches]
+    cache_data = [{'pretty_name': cache.pretty_name, 'hit_count': cache.hit_count, 'stale_hit_count': cache.stale_hit_count, 'miss_count': cache.miss_count, 'rounded_count': cache.rounded_count} for cache in caches]
     return render_to_response('argcache/view_all.html', {'caches': cache_data})
 
 @login_required
@@ -43,3 +44,9 @@ def flush(request, cache_id):
     cache = sorted(all_caches, key=lambda c: c.name)[int(cache_id)]
     cache.delete_all()
     return redirect(reverse('view_all'))
+
+@login_required
+def dependencies(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    return render_to_response('argcache/dependencies.html', {'caches': dependency_report()})
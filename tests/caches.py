@@ -1,6 +1,10 @@
+import threading
 import time
-from argcache.function import cache_function, depend_on_cache
+from argcache.function import cache_function, cache_function_for, depend_on_cache, ensure_token, \
+    ensure_path_token
+from argcache.backends import get_cache
 from argcache.key_set import wildcard
+from .models import HashTag
 
 # make sure cached inclusion tags are imported by the cache loader
 from .templatetags import test_tags
@@ -16,12 +20,88 @@ def get_calls(x):
 def get_calls_reset():
     counter[0] = 0
 
+@cache_function
+def get_fail_calls(x):
+    counter[0] += 1
+    raise ValueError(x)
+
 @cache_function([
     depend_on_cache(get_calls, lambda x=wildcard: {'x': x})
 ])
 def get_squared_calls(x):
     return get_calls(x)**2
 
+# a diamond: get_sum_calls depends on get_calls both directly and through
+# get_squared_calls
+@cache_function([
+    depend_on_cache(get_calls, lambda x=wildcard: {'x': x}),
+    depend_on_cache(get_squared_calls, lambda x=wildcard: {'x': x}),
+])
+def get_sum_calls(x):
+    return get_calls(x) + get_squared_calls(x)
+
+@cache_function([
+    ensure_token(('x', 'y')),
+    ensure_token(('x',)),
+])
+def get_sum4(w, x, y, z):
+    return w + x + y + z
+
+tree_counter = [0]
+@cache_function([ensure_path_token('path', ('owner',), depth=2)])
+def get_tree_calls(owner, path):
+    tree_counter[0] += 1
+    return tree_counter[0]
+
+@cache_function([
+    ensure_token(('owner', 'path')),
+    ensure_path_token('path', ('owner',), depth=2),
+])
+def get_tree_extra_calls(owner, path, extra):
+    tree_counter[0] += 1
+    return tree_counter[0]
+
+@cache_function([ensure_path_token('path', ('owner',), depth=2)])
+def get_tree_only_calls(owner, path, extra):
+    tree_counter[0] += 1
+    return tree_counter[0]
+
+local_counter = [0]
+@cache_function(local_entries=2)
+def get_local_calls(x):
+    local_counter[0] += 1
+    return local_counter[0]
+
+slow_counter = [0]
+# cleared to hold computations until a test lets them finish
+slow_gate = threading.Event()
+slow_gate.set()
+@cache_function(single_flight=True)
+def get_slow_calls(x):
+    slow_counter[0] += 1
+    time.sleep(0.2)
+    slow_gate.wait(10)
+    return slow_counter[0]
+
+stale_counter = [0]
+@cache_function(stale_ttl=60)
+def get_stale_calls(x):
+    stale_counter[0] += 1
+    return stale_counter[0]
+
+timed_counter = [0]
+@cache_function_for(60)
+def get_timed_calls(x):
+    timed_counter[0] += 1
+    return timed_counter[0]
+
+token_store = get_cache('tokens')
+split_counter = [0]
+@cache_function(token_cache='tokens')
+def get_split_calls(x):
+    split_counter[0] += 1
+    return split_counter[0]
+
 value = [0]
 def set_value(x):
     value[0] = x
@@ -37,3 +117,8 @@ def get_value_slowly():
     time.sleep(1)
     return x
 get_value_slowly.depend_on_cache(get_value, lambda: {})
+
+# auto_depend, but never watched in this process
+@cache_function(auto_depend=True, auto_depend_calls=0)
+def get_hashtag_labels():
+    return sorted(HashTag.objects.values_list('label', flat=True))
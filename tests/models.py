@@ -1,6 +1,8 @@
 from django.db import models
 from argcache.function import cache_function, depend_on_row, ensure_token
+from argcache.invalidation import InvalidatingManager
 from argcache.key_set import wildcard
+from argcache.marinade import ref
 from argcache.extras.derivedfield import DerivedField
 
 # some test models
@@ -8,6 +10,11 @@ from argcache.extras.derivedfield import DerivedField
 class HashTag(models.Model):
     label = models.CharField(max_length=40, unique=True)
 
+    @cache_function
+    def num_articles(self):
+        return self.articles.count()
+    num_articles.depend_on_m2m('tests.Article', 'hashtags', lambda article, hashtag: {'self': ref(HashTag, hashtag)}, pks_only=True)
+
     def __unicode__(self):
         return self.label
 
@@ -30,12 +37,19 @@ class Article(models.Model):
     def num_comments_with_dummy(self, dummy):
         return self.comments.count()
 
+    @cache_function
+    def comment_ids(self):
+        return list(self.comments.values_list('pk', flat=True))
+    comment_ids.depend_on_row('tests.Comment', 'self=article')
+
     def __unicode__(self):
         return self.headline
 
 class Comment(models.Model):
     article = models.ForeignKey('Article', related_name='comments')
 
+    objects = InvalidatingManager()
+
 class Reporter(models.Model):
     first_name = models.CharField(max_length=70)
     last_name = models.CharField(max_length=70)
@@ -80,5 +94,15 @@ class Reporter(models.Model):
     articles_with_headline_and_dummy.get_or_create_token(('self', 'headline'))
     articles_with_headline_and_dummy.depend_on_row(Article, lambda article: {'self': article.reporter, 'headline': article.headline})
 
+    @cache_function
+    def headlines(self):
+        return list(self.articles.values_list('headline', flat=True))
+    headlines.depend_on_row(Article, lambda article: {'self': article.reporter}, fields=['headline', 'reporter'])
+
+    @cache_function(auto_depend=True)
+    def hashtag_labels(self):
+        return sorted(set(HashTag.objects.filter(articles__reporter=self).values_list('label', flat=True)))
+    hashtag_labels.depend_on_row(Article, lambda article: {'self': article.reporter})
+
     def __unicode__(self):
         return self.full_name()
@@ -18,6 +18,19 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'tokens': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tokens',
+    },
+}
+
+# TestCase never commits, so don't wait for it; OnCommitTest turns this on
+ARGCACHE_ON_COMMIT = False
+
 ROOT_URLCONF = 'argcache.urls'
 
 TEMPLATE_LOADERS = [
@@ -36,4 +49,5 @@ TEMPLATES = [
 MIDDLEWARE_CLASSES = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'argcache.middleware.ArgCacheMiddleware',
 ]
@@ -1,18 +1,54 @@
-from django.test import TestCase
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
 from django.test.client import Client
 from django.contrib.auth.models import User
 from django.template import Template, Context
+from django.utils.functional import SimpleLazyObject
 
 import unittest
 import threading
-
-from argcache import registry, queued
-from .caches import (get_calls, get_calls_reset, get_squared_calls,
+import time
+from contextlib import contextmanager
+
+from argcache import registry, queued, invalidation
+from argcache.autodepend import dependency_report
+from argcache.backends import touch
+from argcache.dependencies import add_dependency
+from argcache.dispatch import dispatcher_for, fk_selector
+from argcache.invalidation import invalidation_batch, invalidate_rows
+from argcache.key_set import wildcard, any_of, subtree
+from argcache.marinade import marinade_dish, register_marinade, ref
+from argcache.middleware import ArgCacheMiddleware
+from argcache.scope import request_scope, current_scope
+from argcache.token import _fresh_tokens
+from .caches import (get_calls, get_fail_calls, get_calls_reset, get_squared_calls, get_sum_calls, get_sum4,
+                     get_tree_calls, get_tree_extra_calls, get_tree_only_calls,
+                     get_local_calls, get_slow_calls, slow_counter, slow_gate, get_stale_calls,
+                     get_timed_calls, get_split_calls, get_hashtag_labels, token_store,
+                     counter as calls_counter,
                      set_value, get_value, get_value_slowly)
 from .models import HashTag, Article, Comment, Reporter
 from .templatetags.test_tags import counter, silly_inclusion_tag
 
 
+@contextmanager
+def count_backend_calls(cache):
+    """
+    Counts the get_many calls made to the cache backend.
+    """
+    calls = []
+    get_many = cache.get_many
+    def counting_get_many(keys, *args, **kwargs):
+        calls.append(keys)
+        return get_many(keys, *args, **kwargs)
+    cache.get_many = counting_get_many
+    try:
+        yield calls
+    finally:
+        del cache.get_many
+
+
 class CacheTests(TestCase):
     def setUp(self):
         # create initial objects
@@ -104,6 +140,380 @@ class CacheTests(TestCase):
             top_article_again = reporter.top_article()
         self.assertIsNone(top_article_again)
 
+    def test_get_many(self):
+        """
+        get_many and map look up many argument lists at once, computing
+        only the misses.
+        """
+        get_calls_reset()
+        self.assertEqual(get_calls('a'), 1)
+        self.assertEqual(get_calls.get_many([['a'], ['b']], default='missing'),
+                         [1, 'missing'])
+        self.assertEqual(get_calls.map([('a',), ('b',), ('c',), ('b',)]),
+                         [1, 2, 3, 2])
+        self.assertEqual(get_calls.map([('c',), ('b',), ('a',)]), [3, 2, 1])
+        self.assertEqual(get_calls('e'), 4)
+
+        get_calls.set_many([(['a'], 'x'), (['d'], 'y')])
+        self.assertEqual(get_calls.get_many([['a'], ['d']]), ['x', 'y'])
+        get_calls.delete_all()
+        self.assertEqual(get_calls.get_many([['a'], ['d']]), [None, None])
+
+        # cached methods work on lists of instances
+        reporters = list(Reporter.objects.all())
+        names = Reporter.full_name.map([(r,) for r in reporters])
+        with self.assertNumQueries(0):
+            self.assertEqual(Reporter.full_name.map([(r,) for r in reporters]), names)
+        self.assertEqual(names, [r.full_name() for r in reporters])
+
+    def test_hash_tokens(self):
+        """
+        With hash_tokens, entries store a digest of the token values instead
+        of the values themselves, and entries in either format are honored.
+        """
+        get_calls_reset()
+        self.assertEqual(get_calls('old'), 1)
+        get_calls.hash_tokens = True
+        try:
+            # old-format entries are still valid
+            self.assertEqual(get_calls('old'), 1)
+            self.assertEqual(get_calls('new'), 2)
+            self.assertEqual(get_calls('new'), 2)
+            wrapped = get_calls.cache.get(get_calls.key(['new']))
+            self.assertEqual(len(wrapped), 2)
+            self.assertEqual(len(wrapped[1]), 16)
+
+            # ...and both are invalidated by a token change
+            get_calls.delete_all()
+            self.assertEqual(get_calls('old'), 3)
+            self.assertEqual(get_calls('new'), 4)
+        finally:
+            get_calls.hash_tokens = False
+        # new-format entries are valid after switching back
+        self.assertEqual(get_calls('new'), 4)
+
+    def test_local_cache(self):
+        """
+        Caches with a local tier serve hits from this process, but still
+        check tokens and evict the least recently used entries.
+        """
+        a = get_local_calls('a')
+        hits = get_local_calls.local_hit_count
+        self.assertEqual(get_local_calls('a'), a)
+        self.assertEqual(get_local_calls.local_hit_count, hits + 1)
+
+        # another process deleting the entry from the backend can't touch
+        # our copy, but it still misses
+        key = get_local_calls.key(['a'])
+        copy = get_local_calls.local_cache.get(key)
+        for invalidate_a in (lambda: get_local_calls.delete(['a']),
+                             lambda: get_local_calls.delete_key_set({'x': 'a'})):
+            invalidate_a()
+            get_local_calls.local_cache.set(key, copy, None)
+            self.assertNotEqual(get_local_calls('a'), a)
+            a = get_local_calls('a')
+            copy = get_local_calls.local_cache.get(key)
+        # and tokens are still checked
+        get_local_calls.delete_all()
+        a2 = get_local_calls('a')
+        self.assertNotEqual(a2, a)
+
+        # a gets evicted from the local tier, so it has to come from the backend
+        get_local_calls('b')
+        get_local_calls('c')
+        get_local_calls.cache.delete(get_local_calls.key(['a']))
+        self.assertNotEqual(get_local_calls('a'), a2)
+
+        # with a token snapshot, even the tokens can come from this process
+        get_local_calls.local_token_ttl = 60
+        try:
+            c = get_local_calls('c')
+            token_key = get_local_calls.global_token.key([])
+            get_local_calls.cache.delete(token_key)
+            self.assertEqual(get_local_calls('c'), c)
+            # invalidations in this process are seen right away
+            get_local_calls.delete_all()
+            self.assertNotEqual(get_local_calls('c'), c)
+        finally:
+            get_local_calls.local_token_ttl = 0
+
+    def test_request_scope(self):
+        """
+        Within a request scope, lookups are only fetched once, and
+        invalidations are still seen.
+        """
+        with request_scope():
+            a = get_calls('scoped')
+            with count_backend_calls(get_calls.cache) as calls:
+                self.assertEqual(get_calls('scoped'), a)
+                self.assertEqual(get_calls('scoped'), a)
+            self.assertEqual(calls, [])
+
+            get_calls.delete_all()
+            b = get_calls('scoped')
+            self.assertNotEqual(a, b)
+            with count_backend_calls(get_calls.cache) as calls:
+                self.assertEqual(get_calls('scoped'), b)
+            self.assertEqual(calls, [])
+
+        # outside the scope, we go back to the backend
+        with count_backend_calls(get_calls.cache) as calls:
+            self.assertEqual(get_calls('scoped'), b)
+        self.assertEqual(len(calls), 1)
+
+    def test_middleware_scope(self):
+        """
+        ArgCacheMiddleware ends its scope if the view raises, and starts
+        each request with a fresh scope even if one was left open.
+        """
+        middleware = ArgCacheMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        self.assertIsNotNone(current_scope())
+        middleware.process_exception(request, ValueError())
+        self.assertIsNone(current_scope())
+        middleware.process_response(request, None)
+        self.assertIsNone(current_scope())
+
+        leaked = request_scope()
+        leaked.__enter__()
+        get_calls('leaked')
+        middleware.process_request(request)
+        self.assertIsNot(current_scope(), leaked.scope)
+        with count_backend_calls(get_calls.cache) as calls:
+            get_calls('leaked')
+        self.assertEqual(len(calls), 1)
+        middleware.process_response(request, None)
+        self.assertIsNone(current_scope())
+        # the leaked scope can't end the next one
+        with request_scope() as scope:
+            leaked.__exit__(None, None, None)
+            self.assertIs(current_scope(), scope)
+
+    def test_stale_while_revalidate(self):
+        """
+        With stale_ttl, invalidated values are served for a while, and the
+        first caller to notice recomputes them.
+        """
+        stale_key = get_stale_calls._stale_key(get_stale_calls.key(['a']))
+        a = get_stale_calls('a')
+
+        # the first caller to notice refreshes it
+        get_stale_calls.delete_all()
+        stale_hits = get_stale_calls.stale_hit_count
+        b = get_stale_calls('a')
+        self.assertNotEqual(a, b)
+        self.assertEqual(get_stale_calls.stale_hit_count, stale_hits + 1)
+        self.assertEqual(get_stale_calls('a'), b)
+
+        # everybody else gets the stale value in the meantime...
+        get_stale_calls.delete_all()
+        get_stale_calls.cache.add(stale_key, time.time(), 120)
+        self.assertEqual(get_stale_calls('a'), b)
+        self.assertEqual(get_stale_calls('a'), b)
+        # ...but not for too long
+        get_stale_calls.cache.set(stale_key, time.time() - 61, 120)
+        c = get_stale_calls('a')
+        self.assertNotEqual(c, b)
+        self.assertEqual(get_stale_calls('a'), c)
+
+        # refreshing in the background serves the stale value meanwhile
+        get_stale_calls.background_refresh = True
+        try:
+            get_stale_calls.delete_all()
+            self.assertEqual(get_stale_calls('a'), c)
+            for i in range(100):
+                d = get_stale_calls('a')
+                if d != c:
+                    break
+                time.sleep(0.01)
+            self.assertNotEqual(d, c)
+        finally:
+            get_stale_calls.background_refresh = False
+
+        # plain lookups can't refresh, so they don't claim the refresh...
+        e = get_stale_calls('a')
+        get_stale_calls.delete_all()
+        get_stale_calls.cache.delete(stale_key)
+        self.assertIsNone(get_stale_calls.get(['a']))
+        self.assertIsNone(get_stale_calls('a', cache_only=True))
+        self.assertIsNone(get_stale_calls.cache.get(stale_key))
+        # ...or throw the stale value away, so the next caller still can
+        stale_hits = get_stale_calls.stale_hit_count
+        f = get_stale_calls('a')
+        self.assertNotEqual(f, e)
+        self.assertEqual(get_stale_calls.stale_hit_count, stale_hits + 1)
+
+    def test_early_expiry(self):
+        """
+        Entries of caches with a timeout record how long they took, and
+        expensive ones are recomputed before they expire.
+        """
+        a = get_timed_calls('a')
+        wrapped = get_timed_calls.cache.get(get_timed_calls.key(['a']))
+        compute_seconds, expires_at = wrapped[-1]
+        self.assertAlmostEqual(expires_at, time.time() + 60, delta=5)
+        self.assertEqual(get_timed_calls('a'), a)
+
+        # cheap to compute: no need to refresh early
+        get_timed_calls.set(['a'], 'cheap', compute_seconds=0)
+        self.assertEqual(get_timed_calls('a'), 'cheap')
+        # a day to compute and a minute to go: refresh now
+        get_timed_calls.set(['a'], 'expensive', compute_seconds=86400)
+        self.assertNotEqual(get_timed_calls('a'), 'expensive')
+
+        # untimed entries never expire early
+        get_timed_calls.set(['a'], 'untimed')
+        self.assertEqual(len(get_timed_calls.cache.get(get_timed_calls.key(['a']))), 2)
+        self.assertEqual(get_timed_calls('a'), 'untimed')
+
+    def test_defer(self):
+        """
+        Deferred calls, to any cached functions, are looked up together when
+        the first one is used.
+        """
+        get_calls_reset()
+        self.assertEqual(get_calls('deferred'), 1)
+        reporters = list(Reporter.objects.order_by('pk'))
+        with count_backend_calls(get_calls.cache) as calls:
+            names = [Reporter.full_name.defer(r) for r in reporters]
+            calls1 = get_calls.defer('deferred')
+            calls2 = get_calls.defer(x='new')
+            self.assertEqual(calls, [])
+            self.assertEqual(names[0], 'John Doe')
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(calls1, 1)
+            self.assertEqual(calls2, 2)
+            self.assertEqual([str(name) for name in names], ['John Doe', 'Jane Roe', 'Jim Poe'])
+            self.assertEqual(len(calls), 1)
+
+        # and the misses were stored
+        with self.assertNumQueries(0):
+            self.assertEqual(Reporter.full_name.map([(r,) for r in reporters]),
+                             ['John Doe', 'Jane Roe', 'Jim Poe'])
+        self.assertEqual(get_calls('new'), 2)
+
+    def test_defer_scope(self):
+        """
+        Calls deferred in a request scope that ends unused are dropped, not
+        looked up with the next request's.
+        """
+        get_calls_reset()
+        with request_scope():
+            unused = get_calls.defer('unused')
+        with request_scope():
+            used = get_calls.defer('used')
+            self.assertEqual(used, 1)
+        self.assertEqual(calls_counter[0], 1)
+        self.assertEqual(unused, 2)
+
+    def test_defer_failure(self):
+        """
+        If a call in a batch fails, the rest aren't all looked up again.
+        """
+        get_calls_reset()
+        good = get_calls.defer('good')
+        bad = get_fail_calls.defer('bad')
+        self.assertRaises(ValueError, str, bad)
+        self.assertEqual(calls_counter[0], 3) # good, then bad in the batch and alone
+        self.assertEqual(good, 1)
+        self.assertRaises(ValueError, str, bad)
+        self.assertEqual(calls_counter[0], 4)
+
+    def test_incr_tokens(self):
+        """
+        Tokens can be invalidated by incrementing them instead.
+        """
+        get_calls_reset()
+        token = get_calls.global_token
+        token_key = token.key([])
+        token.incr = True
+        try:
+            self.assertEqual(get_calls('incr'), 1)
+            version = get_calls.cache.get(token_key)
+            get_calls.delete_all()
+            self.assertEqual(get_calls.cache.get(token_key), version + 1)
+            self.assertEqual(get_calls('incr'), 2)
+            self.assertEqual(get_calls('incr'), 2)
+
+            # a lost token comes back with a version beyond the old ones
+            get_calls.cache.delete(token_key)
+            get_calls.delete_all()
+            self.assertGreater(get_calls.cache.get(token_key), version + 1)
+            self.assertEqual(get_calls('incr'), 3)
+        finally:
+            token.incr = False
+
+    def test_token_lifetime(self):
+        """
+        Tokens expire at jittered times, and are extended while in use.
+        """
+        get_calls_reset()
+        token = get_calls.global_token
+        token_key = token.key([])
+        for i in range(20):
+            self.assertTrue(0.9 * 86400 <= token.lifetime() <= 86400)
+
+        touched = []
+        def touch(key, timeout):
+            touched.append((key, timeout))
+            return True
+        token.cache.touch = touch
+        try:
+            _fresh_tokens.clear()
+            token.cache.delete(token_key)
+            get_calls('life')
+            get_calls('life')
+            # we made the token, so we know it's good for a while
+            self.assertEqual(touched, [])
+            _fresh_tokens.clear()
+            get_calls('life')
+            get_calls('life')
+            self.assertEqual([key for key, timeout in touched], [token_key])
+        finally:
+            del token.cache.touch
+
+    def test_touch_memcached(self):
+        """
+        On memcached, tokens are extended with the client's touch, even
+        though Django's backend doesn't have it.
+        """
+        touched = []
+        class library(object):
+            class Client(object):
+                def __init__(self, servers):
+                    pass
+                def touch(self, key, time):
+                    touched.append((key, time))
+                    return 1
+        backend = BaseMemcachedCache('127.0.0.1:11211', {}, library, ValueError)
+        self.assertFalse(hasattr(backend, 'touch'))
+        self.assertTrue(touch(backend, 'token', 60))
+        self.assertEqual(touched, [(backend.make_key('token'), 60)])
+        # other backends without touch() can't
+        self.assertIsNone(touch(token_store, 'token', 60))
+
+    def test_token_cache(self):
+        """
+        Tokens can be kept in a separate backend, given by its alias.
+        """
+        token_key = get_split_calls.global_token.key([])
+        self.assertEqual(get_split_calls('a'), get_split_calls('a'))
+        self.assertIsNotNone(token_store.get(token_key))
+        self.assertIsNone(get_split_calls.cache.get(token_key))
+        first = get_split_calls('a')
+        get_split_calls.delete_all()
+        self.assertNotEqual(get_split_calls('a'), first)
+
+        # one request to each backend
+        get_split_calls('b')
+        with count_backend_calls(get_split_calls.cache) as value_calls:
+            with count_backend_calls(token_store) as token_calls:
+                get_split_calls.get_many([['a'], ['b']])
+        self.assertEqual(len(value_calls), 1)
+        self.assertEqual(len(token_calls), 1)
+        self.assertEqual(set(token_calls[0]), set([token_key]))
+
     def test_kwargs(self):
         """
         Cached functions handle keyword arguments, *args, and **kwargs
@@ -160,6 +570,153 @@ class CacheTests(TestCase):
             cnt3 = article.num_comments()
         self.assertEqual(cnt3, cnt2)
 
+    def test_invalidation_batch(self):
+        """
+        Invalidations made in a batch wait for it to end, and are only made
+        once each.
+        """
+        article = Article.objects.get(pk=1)
+        cnt1 = article.num_comments()
+        article.num_comments_with_dummy(None)
+        deleted = []
+        delete = Article.num_comments.cache.delete
+        def counting_delete(key, *args, **kwargs):
+            deleted.append(key)
+            return delete(key, *args, **kwargs)
+        Article.num_comments.cache.delete = counting_delete
+        try:
+            with invalidation_batch():
+                for pk in range(3, 6):
+                    article.comments.create(pk=pk)
+                with self.assertNumQueries(0):
+                    self.assertEqual(article.num_comments(), cnt1)
+        finally:
+            del Article.num_comments.cache.delete
+        # once each for num_comments, num_comments_with_dummy's token,
+        # comment_ids, and top_article, which depends on num_comments
+        self.assertEqual(len(deleted), 4)
+        self.assertEqual(article.num_comments(), cnt1 + 3)
+
+    def test_invalidate_rows(self):
+        """
+        Bulk updates invalidate the rows they change, before and after.
+        """
+        article1 = Article.objects.get(pk=1)
+        article2 = Article.objects.get(pk=2)
+        cnt1 = article1.num_comments()
+        cnt2 = article2.num_comments()
+        # a row at a time, even though the rows stop matching as we go
+        chunk_size, invalidation.CHUNK_SIZE = invalidation.CHUNK_SIZE, 1
+        try:
+            self.assertEqual(Comment.objects.filter(article=article1).update(article=article2), cnt1)
+        finally:
+            invalidation.CHUNK_SIZE = chunk_size
+        self.assertEqual(article1.num_comments(), 0)
+        self.assertEqual(article2.num_comments(), cnt1 + cnt2)
+
+        Comment.objects.bulk_create([Comment(pk=10, article=article1),
+                                     Comment(pk=11, article=article1)])
+        self.assertEqual(article1.num_comments(), 2)
+
+        # sqlite doesn't give us the new pks, so everything goes
+        selected = []
+        handled = []
+        def selector(comment):
+            selected.append(comment)
+            return {'self': comment}
+        def handler(key_sets, using):
+            handled.append(key_sets)
+        dispatcher = dispatcher_for(Comment)
+        dispatcher.add_row_handler(selector, None, handler)
+        try:
+            Comment.objects.bulk_create([Comment(article=article1), Comment(article=article1)])
+        finally:
+            dispatcher.row_handlers.remove((selector, None, handler))
+        self.assertEqual(selected, [])
+        self.assertEqual(handled, [{}])
+        self.assertEqual(article1.num_comments(), 4)
+        Comment.objects.filter(article=article1, pk__gt=11).delete()
+        self.assertEqual(article2.num_comments(), cnt1 + cnt2)
+
+        # raw changes need to be invalidated by hand
+        Comment._base_manager.filter(pk=10).update(article=article2)
+        self.assertEqual(article2.num_comments(), cnt1 + cnt2)
+        invalidate_rows(Comment, [10], chunk_size=1)
+        self.assertEqual(article2.num_comments(), cnt1 + cnt2 + 1)
+
+    def test_depend_on_row_fields(self):
+        """
+        depend_on_row with fields only invalidates when those fields change,
+        and follows foreign keys that move.
+        """
+        reporter1 = Reporter.objects.get(pk=1)
+        reporter2 = Reporter.objects.get(pk=2)
+        self.assertEqual(reporter1.headlines(), ['Breaking News', 'Article II'])
+        self.assertEqual(reporter2.headlines(), [])
+
+        # irrelevant changes
+        article = Article.objects.get(pk=1)
+        article.content = 'Something else'
+        article.save()
+        article.headline = 'Not saved'
+        article.save(update_fields=['content'])
+        with self.assertNumQueries(0):
+            self.assertEqual(reporter1.headlines(), ['Breaking News', 'Article II'])
+
+        # until the headline is saved too
+        article.save()
+        self.assertEqual(reporter1.headlines(), ['Not saved', 'Article II'])
+        article.headline = 'Breaking News'
+        article.save()
+        self.assertEqual(reporter1.headlines(), ['Breaking News', 'Article II'])
+
+        # moving the article invalidates both reporters
+        article = Article.objects.get(pk=1)
+        article.reporter = reporter2
+        article.save()
+        self.assertEqual(reporter1.headlines(), ['Article II'])
+        self.assertEqual(reporter2.headlines(), ['Breaking News'])
+
+    def test_depend_on_row_fk(self):
+        """
+        depend_on_row can follow a foreign key without loading the row.
+        """
+        article = Article.objects.get(pk=1)
+        self.assertEqual(article.comment_ids(), [1, 2])
+        comment = Comment.objects.create(pk=3, article_id=1)
+        self.assertEqual(article.comment_ids(), [1, 2, 3])
+
+        selector = fk_selector(Comment, 'article', 'self')
+        comment = Comment.objects.get(pk=3)
+        with self.assertNumQueries(0):
+            key_set = selector(comment)
+            self.assertEqual(marinade_dish(key_set['self']), marinade_dish(article))
+            self.assertEqual(key_set['self'], ref(Article, 1))
+        with self.assertNumQueries(1):
+            self.assertEqual(key_set['self'].headline, article.headline)
+
+    def test_model_dispatcher(self):
+        """
+        Each model has one dispatcher, which calls each selector once per row.
+        """
+        self.assertIs(fk_selector(Comment, 'article', 'self'),
+                      fk_selector(Comment, 'article', 'self'))
+        dispatcher = dispatcher_for(Article, create=False)
+        self.assertIsNotNone(dispatcher)
+        self.assertGreater(len(dispatcher.row_handlers), 1)
+
+        selected = []
+        handled = []
+        def selector(article):
+            selected.append(article)
+            return {'self': article}
+        def handler(key_sets, using):
+            handled.append(key_sets)
+        article = Article.objects.get(pk=1)
+        dispatcher._run([(selector, None, handler), (selector, None, handler)], article, None)
+        self.assertEqual(selected, [article])
+        self.assertEqual(handled, [{'self': article}] * 2)
+
     def test_depend_on_row_with_dummy(self):
         """
         depend_on_row still works correctly when there are other arguments to the function.
@@ -416,6 +973,214 @@ class CacheTests(TestCase):
             with_hashtag2_again = reporter.articles_with_hashtag(hashtag2.label)
         self.assertEqual(with_hashtag2_again, with_hashtag2_removed)
 
+    def test_depend_on_m2m_pks_only(self):
+        """
+        depend_on_m2m can work from primary keys, from either side.
+        """
+        article1 = Article.objects.get(pk=1)
+        article3 = Article.objects.get(pk=3)
+        hashtag1 = HashTag.objects.get(pk=1)
+        hashtag2 = HashTag.objects.get(pk=2)
+        self.assertEqual(hashtag1.num_articles(), 1)
+        self.assertEqual(hashtag2.num_articles(), 1)
+
+        article1.hashtags.add(hashtag1)
+        self.assertEqual(hashtag1.num_articles(), 2)
+        hashtag2.articles.add(article3)
+        self.assertEqual(hashtag2.num_articles(), 2)
+
+        # clearing only affects what was linked
+        article3.hashtags.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(hashtag1.num_articles(), 2)
+        self.assertEqual(hashtag2.num_articles(), 1)
+        hashtag1.articles.clear()
+        self.assertEqual(hashtag1.num_articles(), 0)
+
+    def test_auto_depend(self):
+        """
+        auto_depend finds the tables a function uses that it didn't declare.
+        """
+        reporter = Reporter.objects.create(first_name='Auto', last_name='Depend')
+        article = Article.objects.create(headline='Inferred', content='', reporter=reporter)
+        hashtag = HashTag.objects.create(label='#inferred')
+        self.assertEqual(reporter.hashtag_labels(), [])
+        article.hashtags.add(hashtag)
+        self.assertEqual(reporter.hashtag_labels(), ['#inferred'])
+        hashtag.label = '#renamed'
+        hashtag.save()
+        self.assertEqual(reporter.hashtag_labels(), ['#renamed'])
+
+        report = dict((cache['name'], cache) for cache in dependency_report())
+        report = report[Reporter.hashtag_labels.name]
+        self.assertEqual(report['declared'], ['tests.Article'])
+        self.assertEqual(report['undeclared'], ['tests.Article_hashtags', 'tests.HashTag'])
+        self.assertEqual(report['unused'], [])
+
+        # models another process inferred are depended on here too
+        self.assertEqual(get_hashtag_labels(), ['#hashtag', '#news', '#renamed'])
+        get_hashtag_labels.cache.set('AUTODEPEND__' + get_hashtag_labels.name, ['tests.HashTag'], None)
+        hashtag.label = '#elsewhere'
+        hashtag.save()
+        self.assertEqual(get_hashtag_labels(), ['#elsewhere', '#hashtag', '#news'])
+        HashTag.objects.filter(pk=hashtag.pk).update(label='#raw')
+        invalidate_rows(HashTag, [hashtag])
+        self.assertEqual(get_hashtag_labels(), ['#hashtag', '#news', '#raw'])
+
+    def test_dependency_graph(self):
+        """
+        Invalidations reach each dependent cache once, however many ways
+        they get there, and dependency cycles are refused.
+        """
+        get_calls_reset()
+        self.assertEqual(get_sum_calls(1), 2)
+        deleted = []
+        delete_values = get_sum_calls._delete_values
+        def counting_delete_values(keys):
+            deleted.append(list(keys))
+            return delete_values(keys)
+        get_sum_calls._delete_values = counting_delete_values
+        try:
+            get_calls.delete([1])
+        finally:
+            del get_sum_calls._delete_values
+        self.assertEqual(deleted, [[get_sum_calls.key([1])]])
+        self.assertEqual(get_sum_calls(1), 6)
+
+        with self.assertRaises(ValueError):
+            add_dependency(get_sum_calls, get_calls, lambda x=wildcard: {'x': x}, lambda **kwargs: True)
+
+    def test_delete_key_sets(self):
+        """
+        Many key sets are deleted with one request, and any_of() stands for
+        several values at once.
+        """
+        reporters = list(Reporter.objects.all())
+        for reporter in reporters:
+            reporter.articles_with_headline_and_dummy(None, 'Article II')
+            reporter.full_name()
+        calls = []
+        delete_many = Reporter.full_name.cache.delete_many
+        def counting_delete_many(keys, *args, **kwargs):
+            calls.append(sorted(keys))
+            return delete_many(keys, *args, **kwargs)
+        Reporter.full_name.cache.delete_many = counting_delete_many
+        try:
+            Reporter.articles_with_headline_and_dummy.delete_key_sets(
+                {'self': any_of(reporters), 'headline': 'Article II'})
+            Reporter.full_name.delete_key_sets([{'self': reporters[0]}, {'self': any_of(reporters[1:])}])
+        finally:
+            del Reporter.full_name.cache.delete_many
+        self.assertEqual([len(keys) for keys in calls], [3, 3])
+        misses = Reporter.full_name.miss_count
+        with self.assertNumQueries(3):
+            for reporter in reporters:
+                reporter.articles_with_headline_and_dummy(None, 'Article II')
+                reporter.full_name()
+        self.assertEqual(Reporter.full_name.miss_count, misses + 3)
+
+    def test_subtree(self):
+        """
+        Deleting a subtree gets everything at or below it, and nothing else.
+        """
+        paths = ['a', 'a/b', 'a/b/c', 'a/bc', 'x']
+        before = dict((path, get_tree_calls(1, path)) for path in paths)
+        other = get_tree_calls(2, 'a/b')
+        get_tree_calls.delete_key_set({'owner': 1, 'path': subtree('a/b')})
+        for path in paths:
+            self.assertEqual(get_tree_calls(1, path) == before[path],
+                             path in ['a', 'a/bc', 'x'])
+        self.assertEqual(get_tree_calls(2, 'a/b'), other)
+
+        # past the depth, we round up to the deepest ancestor we can do
+        rounded = get_tree_calls.rounded_count
+        before = dict((path, get_tree_calls(1, path)) for path in paths)
+        get_tree_calls.delete_key_set({'owner': 1, 'path': subtree(['a', 'b', 'c', 'd'])})
+        self.assertEqual(get_tree_calls.rounded_count, rounded + 1)
+        self.assertNotEqual(get_tree_calls(1, 'a/b'), before['a/b'])
+        self.assertEqual(get_tree_calls(1, 'a'), before['a'])
+
+        # without the owner, there's no path token, so everything goes
+        get_tree_calls.delete_key_set({'path': subtree('x')})
+        self.assertNotEqual(get_tree_calls(2, 'a/b'), other)
+
+    def test_subtree_exact_path(self):
+        """
+        Deleting one exact path still works next to a path token.
+        """
+        a, abc = get_tree_extra_calls(1, 'a/b', 0), get_tree_extra_calls(1, 'a/b/c', 0)
+        get_tree_extra_calls.delete_key_set({'owner': 1, 'path': 'a/b'})
+        self.assertNotEqual(get_tree_extra_calls(1, 'a/b', 0), a)
+        self.assertEqual(get_tree_extra_calls(1, 'a/b/c', 0), abc)
+
+        # with only the path token, it's rounded up, but still deleted
+        a = get_tree_only_calls(1, 'a/b', 0)
+        get_tree_only_calls.delete_key_set({'owner': 1, 'path': 'a/b'})
+        self.assertNotEqual(get_tree_only_calls(1, 'a/b', 0), a)
+
+    def test_key_plan(self):
+        """
+        Keys built from the key plan are the ones the tokens would make.
+        """
+        reporter = Reporter.objects.get(pk=1)
+        for cache_obj, arg_list in [(get_sum4, [1, 2L, u'\xc5', 'z']),
+                                    (get_tree_calls, [reporter, 'a/b/c']),
+                                    (Reporter.articles_with_headline_and_dummy,
+                                     [reporter, [1, reporter], 'headline'])]:
+            key, token_keys = cache_obj._lookup_keys(arg_list)
+            self.assertEqual(key, cache_obj.key(arg_list))
+            self.assertEqual(token_keys, [token.key(arg_list) for token in cache_obj.tokens])
+
+    def test_register_marinade(self):
+        """
+        Types can say how to marinade them, and their subclasses go along.
+        """
+        class Point(object):
+            def __init__(self, x, y):
+                self.x, self.y = x, y
+        class Point3(Point):
+            pass
+        self.assertNotEqual(marinade_dish(Point(1, 2)), '1,2')
+        register_marinade(Point, lambda point: '%d,%d' % (point.x, point.y))
+        self.assertEqual(marinade_dish(Point(1, 2)), '1,2')
+        self.assertEqual(marinade_dish(Point3(1, 2)), '1,2')
+        self.assertEqual(marinade_dish([Point(1, 2), 3]), '[1,2,3]')
+
+        # a subclass's own __marinade__ still wins
+        class Point4(Point):
+            def __marinade__(self):
+                return 'four'
+        self.assertEqual(marinade_dish(Point4(1, 2)), 'four')
+
+    def test_marinade_proxies(self):
+        """
+        Lazy objects marinade like what they stand for, and int subclasses
+        keep their own __marinade__.
+        """
+        reporter = Reporter.objects.get(pk=1)
+        lazy = SimpleLazyObject(lambda: reporter)
+        self.assertEqual(marinade_dish(lazy), marinade_dish(reporter))
+        self.assertEqual(marinade_dish(SimpleLazyObject(lambda: [1, 2])), '[1,2]')
+        class Weird(int):
+            def __marinade__(self):
+                return 'weird'
+        self.assertEqual(marinade_dish(Weird(3)), 'weird')
+        self.assertEqual(marinade_dish(3), '3')
+
+    def test_find_token(self):
+        """
+        Invalidations use the most specific token they can, and count when
+        that's broader than they asked for.
+        """
+        rounded = get_sum4.rounded_count
+        self.assertEqual(get_sum4.find_token({'x': 1, 'y': 2}).provided_params, (1, 2))
+        self.assertEqual(get_sum4.rounded_count, rounded)
+        self.assertEqual(get_sum4.find_token({'x': 1, 'y': 2, 'z': 3}).provided_params, (1, 2))
+        self.assertEqual(get_sum4.find_token({'x': 1, 'z': 3}).provided_params, (1,))
+        self.assertEqual(get_sum4.find_token({'w': 1, 'z': 3}).provided_params, ())
+        self.assertEqual(get_sum4.rounded_count, rounded + 3)
+        self.assertEqual(get_sum4.roundings[('x', 'y', 'z')], 1)
+
     def test_depend_on_model(self):
         """
         depend_on_model triggers cache invalidation when any instance
@@ -462,6 +1227,12 @@ class CacheViewTests(TestCase):
         for name in cached_functions:
             self.assertContains(resp, name)
 
+    def test_dependencies_view(self):
+        c = Client()
+        c.login(username='testuser', password='testpass')
+        resp = c.get('/dependencies')
+        self.assertContains(resp, 'Reporter.hashtag_labels')
+
     def test_view_flush(self):
         c = Client()
         c.login(username='testuser', password='testpass')
@@ -485,6 +1256,106 @@ class CacheViewTests(TestCase):
         self.assertNotEqual(b, c)
 
 
+class UpdateCommitTest(TransactionTestCase):
+    def test_invalidated_after_commit(self):
+        """
+        InvalidatingQuerySet.update() invalidates once its transaction has
+        committed, so nothing can cache the old rows in between.
+        """
+        reporter = Reporter.objects.create(first_name='Up', last_name='Date')
+        article1 = Article.objects.create(headline='One', content='', reporter=reporter)
+        article2 = Article.objects.create(headline='Two', content='', reporter=reporter)
+        Comment.objects.create(article=article1)
+        # other tests' rows had the same pks
+        Article.num_comments.delete_all()
+        self.assertEqual(article2.num_comments(), 0)
+
+        in_atomic_block = []
+        flush = invalidation._Invalidations.flush
+        def recording_flush(batch):
+            in_atomic_block.append(connection.in_atomic_block)
+            return flush(batch)
+        invalidation._Invalidations.flush = recording_flush
+        try:
+            self.assertEqual(Comment.objects.filter(article=article1).update(article=article2), 1)
+        finally:
+            invalidation._Invalidations.flush = flush
+        self.assertEqual(in_atomic_block, [False])
+        self.assertEqual(article2.num_comments(), 1)
+
+
+class _Rollback(Exception):
+    pass
+
+@contextmanager
+def commit_hooks():
+    """
+    Gives Django before 1.9 a transaction.on_commit() like later ones',
+    which runs its functions once the outermost atomic block has committed,
+    and drops them if it rolls back.
+    """
+    if hasattr(transaction, 'on_commit'):
+        yield
+        return
+    def on_commit(func, using=None):
+        if connection.in_atomic_block:
+            connection.run_on_commit.append((set(connection.savepoint_ids), func))
+        else:
+            func()
+    def rollback():
+        rollback_()
+        connection.run_on_commit = []
+    def atomic_exit(self, exc_type, exc_value, traceback):
+        atomic_exit_(self, exc_type, exc_value, traceback)
+        if not connection.in_atomic_block:
+            run_on_commit, connection.run_on_commit = connection.run_on_commit, []
+            for sids, func in run_on_commit:
+                func()
+    rollback_, atomic_exit_ = connection.rollback, transaction.Atomic.__dict__['__exit__']
+    connection.run_on_commit = []
+    connection.rollback = rollback
+    transaction.Atomic.__exit__ = atomic_exit
+    transaction.on_commit = on_commit
+    try:
+        yield
+    finally:
+        del transaction.on_commit
+        transaction.Atomic.__exit__ = atomic_exit_
+        del connection.rollback, connection.run_on_commit
+
+@override_settings(ARGCACHE_ON_COMMIT=True)
+class OnCommitTest(TransactionTestCase):
+    def setUp(self):
+        self.reporter = Reporter.objects.create(first_name='On', last_name='Commit')
+        hooks = commit_hooks()
+        hooks.__enter__()
+        self.addCleanup(hooks.__exit__, None, None, None)
+
+    def test_deferred_until_commit(self):
+        reporter = self.reporter
+        self.assertEqual(reporter.full_name(), 'On Commit')
+        with transaction.atomic():
+            reporter.first_name = 'Off'
+            reporter.save()
+            self.assertEqual(reporter.full_name(), 'On Commit')
+        self.assertEqual(reporter.full_name(), 'Off Commit')
+
+    def test_dropped_on_rollback(self):
+        reporter = self.reporter
+        self.assertEqual(reporter.full_name(), 'On Commit')
+        misses = Reporter.full_name.miss_count
+        try:
+            with transaction.atomic():
+                reporter.first_name = 'Off'
+                reporter.save()
+                raise _Rollback
+        except _Rollback:
+            pass
+        reporter = Reporter.objects.get(pk=reporter.pk)
+        self.assertEqual(reporter.full_name(), 'On Commit')
+        self.assertEqual(Reporter.full_name.miss_count, misses)
+
+
 class CacheInclusionTagTest(TestCase):
     # Makes use of the tags in tests/templatetags/test_tags.py
     # This is one giant test because the ordering matters.
@@ -642,13 +1513,14 @@ class CacheConcurrencyTest(TestCase):
         for e in exceptions:
             raise e
 
-    @unittest.skip("Known issue, see Github #2")
     def test_race_cached_function(self):
         set_value(1)
         def a():
             x = get_value_slowly()
             self.assertEqual(x, 1)
         def b():
+            # invalidate while a is computing, after it has read the value
+            time.sleep(0.2)
             set_value(2)
             x = get_value()
             self.assertEqual(x, 2)
@@ -656,3 +1528,86 @@ class CacheConcurrencyTest(TestCase):
         x = get_value()
         y = get_value_slowly()
         self.assertEqual(x, y)
+
+    def test_single_flight_threads(self):
+        """
+        Concurrent misses in one process share a single computation.
+        """
+        results = []
+        def a():
+            results.append(get_slow_calls('threads'))
+        calls = slow_counter[0]
+        self.call_concurrently([a, a, a, a])
+        self.assertEqual(slow_counter[0], calls + 1)
+        self.assertEqual(results, [calls + 1] * 4)
+
+    @contextmanager
+    def lease_checked(self, lease_key):
+        """
+        Gives an event that is set once someone has found lease_key still
+        held, i.e. they're waiting on it.
+        """
+        checked = threading.Event()
+        get = get_slow_calls.cache.get
+        def checking_get(key, *args, **kwargs):
+            value = get(key, *args, **kwargs)
+            if key == lease_key:
+                checked.set()
+            return value
+        get_slow_calls.cache.get = checking_get
+        try:
+            yield checked
+        finally:
+            del get_slow_calls.cache.get
+
+    def test_single_flight_lease(self):
+        """
+        A miss waits for another process holding the lease to store the
+        value, rather than computing it again.
+        """
+        # the lease is taken on the key being looked up, as the other
+        # process would, and only let go once we're waiting on it
+        lease_key = 'LEASE__' + get_slow_calls.key(['lease'])
+        get_slow_calls.cache.add(lease_key, 1, 30)
+        with self.lease_checked(lease_key) as checked:
+            def other_process():
+                checked.wait(10)
+                get_slow_calls.set(['lease'], 'theirs')
+                get_slow_calls.cache.delete(lease_key)
+            calls = slow_counter[0]
+            t = threading.Thread(target=other_process)
+            t.start()
+            self.assertEqual(get_slow_calls('lease'), 'theirs')
+            t.join()
+        self.assertEqual(slow_counter[0], calls)
+
+        # but if they give up, we compute it ourselves
+        lease_key = 'LEASE__' + get_slow_calls.key(['lease2'])
+        get_slow_calls.cache.add(lease_key, 1, 30)
+        with self.lease_checked(lease_key) as checked:
+            def give_up():
+                checked.wait(10)
+                get_slow_calls.cache.delete(lease_key)
+            t = threading.Thread(target=give_up)
+            t.start()
+            self.assertEqual(get_slow_calls('lease2'), calls + 1)
+            t.join()
+            self.assertTrue(checked.is_set())
+
+    def test_submit(self):
+        """
+        submit() computes in the background, sharing the computation between
+        concurrent submissions.
+        """
+        calls = slow_counter[0]
+        # hold the computation, so the second submission comes while it runs
+        slow_gate.clear()
+        try:
+            r1 = get_slow_calls.submit('submit')
+            r2 = get_slow_calls.submit(x='submit')
+            self.assertIs(r1, r2)
+        finally:
+            slow_gate.set()
+        self.assertEqual(r1.get(5), calls + 1)
+        self.assertEqual(get_slow_calls.submit('submit').get(5), calls + 1)
+        self.assertEqual(slow_counter[0], calls + 1)